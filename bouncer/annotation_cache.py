@@ -0,0 +1,104 @@
+import threading
+import time
+
+from cachetools import TTLCache
+
+#: Cached result for an annotation that doesn't exist in Elasticsearch.
+NOT_FOUND = "not_found"
+
+#: Cached result for an annotation that has been marked as deleted.
+DELETED = "deleted"
+
+
+class _TTLCache(TTLCache):
+    """A TTLCache that counts the items evicted to make room for new ones."""
+
+    def __init__(self, maxsize, ttl, timer):
+        super().__init__(maxsize, ttl, timer=timer)
+        self.evictions = 0
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+
+class AnnotationCache:
+    """
+    A process-local cache of parsed annotations, keyed by annotation ID.
+
+    Successfully parsed annotations (the dicts returned by
+    :py:func:`bouncer.util.parse_document`) are cached for ``ttl`` seconds.
+    Annotations that weren't found or have been deleted are cached separately
+    for ``negative_ttl`` seconds, so that a flood of requests for missing
+    annotations can't push the hot ones out of the cache.
+
+    Each cache holds at most ``maxsize`` entries. A ``maxsize`` of 0 disables
+    caching.
+    """
+
+    def __init__(self, maxsize, ttl, negative_ttl, timer=time.monotonic):
+        self._lock = threading.Lock()
+        self._enabled = maxsize > 0
+        self._found = _TTLCache(max(maxsize, 1), ttl, timer)
+        self._missing = _TTLCache(max(maxsize, 1), negative_ttl, timer)
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, annotation_id):
+        """
+        Return the cached result for ``annotation_id`` or ``None``.
+
+        The result is either a parsed annotation dict or one of the
+        :py:data:`NOT_FOUND` and :py:data:`DELETED` markers.
+        """
+        with self._lock:
+            result = self._found.get(annotation_id)
+            if result is None:
+                result = self._missing.get(annotation_id)
+
+            if result is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+
+            return result
+
+    def set(self, annotation_id, parsed_document):
+        """Cache the parsed annotation dict for ``annotation_id``."""
+        if self._enabled:
+            with self._lock:
+                self._found[annotation_id] = parsed_document
+
+    def set_missing(self, annotation_id, reason):
+        """Cache that ``annotation_id`` is :py:data:`NOT_FOUND` or :py:data:`DELETED`."""
+        if self._enabled:
+            with self._lock:
+                self._missing[annotation_id] = reason
+
+    def stats(self):
+        """Return a dict of the cache's current size and hit/miss counters."""
+        with self._lock:
+            return {
+                "size": self._found.currsize,
+                "negative_size": self._missing.currsize,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._found.evictions + self._missing.evictions,
+            }
+
+
+def includeme(config):  # pragma: nocover
+    settings = config.registry.settings
+    settings.setdefault("annotation_cache_maxsize", 10000)
+    settings.setdefault("annotation_cache_ttl", 60)
+    settings.setdefault("annotation_cache_negative_ttl", 30)
+
+    config.registry["annotation_cache"] = AnnotationCache(
+        maxsize=int(settings["annotation_cache_maxsize"]),
+        ttl=float(settings["annotation_cache_ttl"]),
+        negative_ttl=float(settings["annotation_cache_negative_ttl"]),
+    )
+    config.add_request_method(
+        lambda r: r.registry["annotation_cache"], name="annotation_cache", reify=True
+    )
@@ -5,6 +5,41 @@ import pyramid.config
 
 from bouncer._version import get_version
 
+#: Settings that are only set if the environment variable of the same name (but
+#: uppercase) is defined. Their defaults are set by the ``includeme()`` of the
+#: module that uses them.
+OPTIONAL_SETTINGS = (
+    "annotation_cache_maxsize",
+    "annotation_cache_negative_ttl",
+    "annotation_cache_ttl",
+    "annotation_page_cache_control",
+    "annotation_page_not_found_cache_control",
+    "annotation_page_not_found_surrogate_control",
+    "annotation_page_surrogate_control",
+    "elasticsearch_url",
+    "elasticsearch_version_refresh_interval",
+    "embed_detector_background",
+    "embed_detector_cache_size",
+    "embed_detector_cache_ttl",
+    "embed_detector_circuit_failure_threshold",
+    "embed_detector_circuit_failure_window",
+    "embed_detector_circuit_reset_timeout",
+    "embed_detector_cold_miss_timeout",
+    "embed_detector_max_bytes",
+    "embed_detector_max_probes",
+    "embed_detector_max_probes_per_host",
+    "embed_detector_max_queued",
+    "embed_detector_max_workers",
+    "embed_detector_patterns_file",
+    "embed_detector_pool_connections",
+    "embed_detector_pool_maxsize",
+    "embed_detector_shared_cache_path",
+    "embed_detector_shared_cache_size",
+    "embed_detector_stop_at_head_end",
+    "resolve_max_ids",
+    "resolve_probe_timeout",
+)
+
 
 def settings():  # pragma: nocover
     """
@@ -39,14 +74,18 @@ def settings():  # pragma: nocover
         "via_base_url": via_base_url,
     }
 
-    if "ELASTICSEARCH_URL" in os.environ:
-        result["elasticsearch_url"] = os.environ["ELASTICSEARCH_URL"]
+    for name in OPTIONAL_SETTINGS:
+        if name.upper() in os.environ:
+            result[name] = os.environ[name.upper()]
+
     return result
 
 
 def create_app(_=None, **_settings):  # pragma: nocover
     """Configure and return the WSGI app."""
     config = pyramid.config.Configurator(settings=settings())
+    version = get_version()
+    config.add_settings({"version": version})
     config.add_static_view(name="static", path="static")
     config.include("pyramid_jinja2")
     config.registry.settings["jinja2.filters"] = {
@@ -54,6 +93,9 @@ def create_app(_=None, **_settings):  # pragma: nocover
         "static_url": "pyramid_jinja2.filters:static_url_filter",
     }
     config.include("bouncer.search")
+    config.include("bouncer.annotation_cache")
+    config.include("bouncer.embed_detector")
+    config.include("bouncer.page_shell")
     config.include("bouncer.views")
 
     # Enable Sentry's "Releases" feature, see:
@@ -67,7 +109,7 @@ def create_app(_=None, **_settings):  # pragma: nocover
     # https://docs.sentry.io/platforms/python/configuration/options/
     config.add_settings(
         {
-            "h_pyramid_sentry.init.release": get_version(),
+            "h_pyramid_sentry.init.release": version,
         }
     )
     config.include("h_pyramid_sentry")
@@ -0,0 +1,253 @@
+"""
+An asyncio (ASGI) serving mode for bouncer.
+
+Serve it with an ASGI server such as uvicorn::
+
+    uvicorn --factory bouncer.asgi:create_app
+
+The annotation, ``/go`` and healthcheck views, whose requests spend most of
+their time waiting on Elasticsearch and on publishers' pages, are handled
+on the event loop with asyncio clients. The parsing and URL logic is shared
+with the WSGI views.
+
+Everything else, including the error pages of those views, is passed to the
+WSGI app which runs in a thread pool. Requests that the async handlers can't
+answer themselves, because an annotation is missing or Elasticsearch failed
+for example, are passed on too, so the WSGI app's behaviour and error
+reporting apply to them unchanged.
+"""
+
+import asyncio
+import io
+import json
+import logging
+from types import SimpleNamespace
+
+from a2wsgi import WSGIMiddleware
+from a2wsgi.wsgi import build_environ
+from elasticsearch import exceptions
+from pyramid import httpexceptions
+from pyramid.interfaces import IRoutesMapper
+from pyramid.request import Request, apply_request_extensions
+from pyramid.threadlocal import RequestContext
+
+from bouncer import (
+    annotation_cache,
+    app,
+    embed_detector,
+    page_shell,
+    search,
+    util,
+    views,
+)
+
+log = logging.getLogger(__name__)
+
+
+class AsyncApp:
+    """The ASGI app that wraps the WSGI app ``router``."""
+
+    def __init__(self, router, es_client=None, probe_client=None):
+        self._registry = router.registry
+        self._wsgi = WSGIMiddleware(router)
+        self._routes = self._registry.getUtility(IRoutesMapper)
+        settings = self._registry.settings
+        self._renderer = page_shell.PageShellRenderer(
+            SimpleNamespace(settings=settings)
+        )
+        self._es = es_client or search.AsyncClient(settings["elasticsearch_url"])
+        self._probe_client = probe_client or embed_detector.async_probe_client()
+        self._handlers = {
+            "annotation_with_url": self.annotation,
+            "annotation_without_url": self.annotation,
+            "goto_url": self.goto_url,
+            "healthcheck": self.healthcheck,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+
+        if scope["type"] == "http" and scope["method"] == "GET":
+            request = self._request(scope)
+            if request is not None:
+                try:
+                    response = await self._handlers[request.matched_route.name](request)
+                except Exception:
+                    # Let the WSGI app have a go, which reports to Sentry if
+                    # it fails too.
+                    log.exception("Async handler failed")
+                    response = None
+
+                if response is not None:
+                    await _send_response(send, response)
+                    return
+
+        await self._wsgi(scope, receive, send)
+
+    async def annotation(self, request):
+        settings = request.registry.settings
+        cache = request.annotation_cache
+        annotation_id = request.matchdict["id"]
+
+        parsed_document = cache.get(annotation_id)
+        if parsed_document is None:
+            parsed_document = await self._get_parsed_document(request)
+            if parsed_document is None:
+                return None
+
+        if parsed_document in (annotation_cache.NOT_FOUND, annotation_cache.DELETED):
+            return None
+
+        etag = views.annotation_etag(settings, parsed_document)
+        if etag in request.if_none_match:
+            response = httpexceptions.HTTPNotModified()
+            views.set_cache_headers(request, response, etag=etag)
+            return response
+
+        try:
+            redirect = views.get_redirect(
+                settings, request.embed_detector, parsed_document
+            )
+        except httpexceptions.HTTPUnprocessableEntity:
+            return None
+
+        is_client_embedded = False
+        if not redirect["always_use_via"]:
+            is_client_embedded = await request.embed_detector.page_embeds_client_async(
+                redirect["document_uri"], self._probe_client
+            )
+
+        response = self._render(
+            request,
+            views.annotation_page(parsed_document, redirect, is_client_embedded),
+        )
+        views.set_cache_headers(request, response, etag=etag)
+        return response
+
+    async def goto_url(self, request):
+        try:
+            value = views.goto_url(request)
+        except httpexceptions.HTTPError:
+            return None
+
+        return self._render(request, value)
+
+    async def healthcheck(self, request):
+        if "sentry" in request.params:
+            # Leave sending the test message to the WSGI view.
+            return None
+
+        try:
+            health = await self._es.cluster_health(
+                request.registry.settings["elasticsearch_index"]
+            )
+        except exceptions.ElasticsearchException:
+            return None
+
+        if health["status"] not in ("yellow", "green"):
+            return None
+
+        response = request.response
+        response.content_type = "application/json"
+        response.text = json.dumps({"status": "okay"})
+        response.cache_expires(0)
+        return response
+
+    async def aclose(self):
+        await self._es.aclose()
+        await self._probe_client.aclose()
+
+    async def _get_parsed_document(self, request):
+        """
+        Fetch, parse and cache the requested annotation.
+
+        Returns ``None`` if the WSGI app should handle the request instead.
+        """
+        es_version = request.es_version
+        if not es_version.known:
+            # Only the first request has to wait for the version probe.
+            await asyncio.to_thread(lambda: es_version.major)
+
+        annotation_id = request.matchdict["id"]
+        try:
+            document = await self._es.get(
+                index=request.registry.settings["elasticsearch_index"],
+                doc_type=es_version.doc_type,
+                id=annotation_id,
+                params={
+                    es_version.source_includes_param: ",".join(util.DOCUMENT_FIELDS)
+                },
+            )
+        except exceptions.NotFoundError:
+            request.annotation_cache.set_missing(
+                annotation_id, annotation_cache.NOT_FOUND
+            )
+            return None
+        except exceptions.ElasticsearchException:
+            es_version.invalidate()
+            return None
+
+        try:
+            return views.parse_and_cache(
+                request.annotation_cache, annotation_id, document
+            )
+        except util.InvalidAnnotationError:
+            return None
+
+    def _request(self, scope):
+        """
+        Return a Pyramid request for ``scope`` if it's for an async handler.
+
+        The request is routed by the WSGI app's own routes.
+        """
+        request = Request(build_environ(scope, io.BytesIO()))
+        request.registry = self._registry
+        info = self._routes(request)
+        if info["route"] is None or info["route"].name not in self._handlers:
+            return None
+
+        request.matchdict = info["match"]
+        request.matched_route = info["route"]
+        apply_request_extensions(request)
+        return request
+
+    def _render(self, request, value):
+        # The templates use Pyramid's threadlocals, which are safe to use here
+        # because nothing else runs on the event loop until this returns.
+        with RequestContext(request):
+            html = self._renderer(value, {"request": request})
+
+        response = request.response
+        response.text = html
+        return response
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            else:  # lifespan.shutdown
+                await self.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+async def _send_response(send, response):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": response.status_int,
+            "headers": [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in response.headerlist
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": response.body})
+
+
+def create_app():  # pragma: nocover
+    """Configure and return the ASGI app."""
+    return AsyncApp(app.create_app())
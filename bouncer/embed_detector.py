@@ -1,45 +1,118 @@
+import asyncio
 import fnmatch
+import functools
+import os
 import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import wait
+from http.cookiejar import CookieJar, DefaultCookiePolicy
 from urllib.parse import urlparse
 
+import httpx
 import requests
-from cachetools import TTLCache, cached
-
-# Hardcoded URL patterns where client is assumed to be embedded.
-#
-# Only the hostname and path are included in the pattern. The path must be
-# specified; use "example.com/*" to match all URLs on a particular domain.
-#
-# Patterns are shell-style wildcards ('*' matches any number of chars, '?'
-# matches a single char).
-PATTERNS = [
-    # Official Hypothesis websites
-    "h.readthedocs.io/*",
-    "web.hypothes.is/blog/*",
-    # Unofficial Hypothesis-affiliated websites
-    "docdrop.org/*",  # See https://github.com/hypothesis/bouncer/issues/389
-    # Publisher partners
-    "psycnet.apa.org/fulltext/*",
-    "awspntest.apa.org/fulltext/*",
-    "*.semanticscholar.org/reader/*",  # See https://hypothes-is.slack.com/archives/C04F8GLTT7U/p1674065065018549
-    # BioRxiv
-    "biotome.hypothes.is/*",
-    "www.biorxiv.org/*",
-    "www.medrxiv.org/*",
-]
-
-COMPILED_PATTERNS = [re.compile(fnmatch.translate(pat)) for pat in PATTERNS]
-
-
-def url_embeds_client(url):  # pragma: nocover
+from cachetools import LRUCache
+from pyramid.settings import asbool
+
+from bouncer.shared_cache import SharedCache
+
+#: The file that the URL patterns of pages that embed the client are loaded
+#: from by default, see :py:func:`load_patterns`.
+PATTERNS_FILE = os.path.join(os.path.dirname(__file__), "embedded_client_patterns.txt")
+
+
+def load_patterns(path):
+    """
+    Return the URL patterns in the file at ``path``.
+
+    The file has one pattern per line. Blank lines and comments starting
+    with "#" are ignored.
+    """
+    with open(path, encoding="utf-8") as patterns_file:
+        lines = (line.partition("#")[0].strip() for line in patterns_file)
+        return [line for line in lines if line]
+
+
+class URLPatternMatcher:
+    """
+    Matches URLs against a list of hostname and path patterns.
+
+    Patterns are shell-style wildcards ('*' matches any number of chars, '?'
+    matches a single char) matched against a URL's hostname and path, for
+    example "www.example.com/articles/*".
+
+    To keep the cost of a lookup flat however many patterns there are, they
+    are indexed by hostname. Patterns for an exact hostname are looked up by
+    the URL's hostname, and patterns for "*.example.com" by each of the URL's
+    domain suffixes. The path patterns for each hostname, and any patterns
+    with other wildcards in their hostname, are compiled into a single regex.
+    """
+
+    def __init__(self, patterns):
+        exact = {}
+        suffix = {}
+        other = []
+
+        for pattern in patterns:
+            host, slash, path = pattern.partition("/")
+            if not _has_wildcard(host):
+                exact.setdefault(host, []).append(slash + path)
+            elif host.startswith("*.") and not _has_wildcard(host[1:]):
+                suffix.setdefault(host[1:], []).append(slash + path)
+            else:
+                other.append(pattern)
+
+        self._exact = {host: _compile(paths) for host, paths in exact.items()}
+        self._suffix = {host: _compile(paths) for host, paths in suffix.items()}
+        self._other = _compile(other) if other else None
+
+    def matches(self, netloc, path):
+        """Return whether a URL's ``netloc`` and ``path`` match a pattern."""
+        paths = self._exact.get(netloc)
+        if paths is not None and paths.fullmatch(path):
+            return True
+
+        if self._suffix:
+            dot = netloc.find(".")
+            while dot != -1:
+                paths = self._suffix.get(netloc[dot:])
+                if paths is not None and paths.fullmatch(path):
+                    return True
+                dot = netloc.find(".", dot + 1)
+
+        return self._other is not None and bool(self._other.fullmatch(netloc + path))
+
+
+def _has_wildcard(pattern):
+    return any(char in pattern for char in "*?[")
+
+
+def _compile(patterns):
+    """Compile a list of shell-style patterns into a single regex."""
+    return re.compile(
+        "|".join(f"(?:{fnmatch.translate(pattern)})" for pattern in patterns)
+    )
+
+
+@functools.cache
+def _default_matcher():
+    return URLPatternMatcher(load_patterns(PATTERNS_FILE))
+
+
+def url_embeds_client(url, matcher=None):  # pragma: nocover
     """
     Test whether ``url`` is known to embed the client.
 
-    This currently just tests the URL against the pattern list ``PATTERNS``.
+    This currently just tests the URL against a list of patterns, those of
+    ``matcher`` or by default those in :py:data:`PATTERNS_FILE`.
 
     Only the hostname and path of the URL are tested. Returns false for non-HTTP
     URLs.
 
+    :type matcher: URLPatternMatcher
     :return: True if the URL matches a pattern.
     """
     parsed_url = urlparse(url)
@@ -49,59 +122,745 @@ def url_embeds_client(url):  # pragma: nocover
     path = parsed_url.path
     if not path:
         path = "/"
-    netloc_and_path = parsed_url.netloc + path
 
-    for pat in COMPILED_PATTERNS:
-        if pat.fullmatch(netloc_and_path):
-            return True
+    if matcher is None:
+        matcher = _default_matcher()
+
+    return matcher.matches(parsed_url.netloc, path)
+
+
+class HostUnavailableError(Exception):
+    """Raised if a page can't be checked because of its host's ProbeLimiter state."""
+
+
+class ProbeLimiter:
+    """
+    Per-host circuit breakers and concurrency limits for page probes.
+
+    If ``failure_threshold`` probes of a host time out or fail within
+    ``failure_window`` seconds then the host's circuit opens and its pages
+    aren't probed for ``reset_timeout`` seconds. After that a single trial
+    probe is let through (the circuit is "half-open"): if it succeeds the
+    circuit closes again, if it fails the circuit re-opens.
+
+    At most ``max_per_host`` probes of any one host, and ``max_total`` probes
+    overall, can be in flight at once.
+    """
+
+    def __init__(
+        self,
+        failure_threshold=5,
+        failure_window=60,
+        reset_timeout=30,
+        max_per_host=4,
+        max_total=20,
+        timer=time.monotonic,
+    ):
+        self._failure_threshold = failure_threshold
+        self._failure_window = failure_window
+        self._reset_timeout = reset_timeout
+        self._max_per_host = max_per_host
+        self._max_total = max_total
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._hosts = LRUCache(maxsize=10000)
+        self._in_flight = 0
+
+    def acquire(self, host):
+        """
+        Reserve a slot for a probe of ``host``.
+
+        :raises HostUnavailableError: if the host's circuit is open or too many
+            probes are already in flight
+        """
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None:
+                state = self._hosts[host] = _HostState()
+
+            if state.opened_at is not None:
+                if (
+                    state.trial_in_flight
+                    or self._timer() - state.opened_at < self._reset_timeout
+                ):
+                    raise HostUnavailableError(f"circuit open for {host}")
+                state.trial_in_flight = True
+
+            if (
+                state.in_flight >= self._max_per_host
+                or self._in_flight >= self._max_total
+            ):
+                state.trial_in_flight = False
+                raise HostUnavailableError(f"too many probes in flight for {host}")
+
+            state.in_flight += 1
+            self._in_flight += 1
+
+    def release(self, host, failed):
+        """Release a slot reserved by :py:meth:`acquire`."""
+        with self._lock:
+            self._in_flight -= 1
+
+            state = self._hosts.get(host)
+            if state is None:
+                return
+            state.in_flight -= 1
+
+            now = self._timer()
+            if state.trial_in_flight:
+                state.trial_in_flight = False
+                state.opened_at = now if failed else None
+                state.failures.clear()
+            elif failed:
+                state.failures.append(now)
+                while state.failures[0] <= now - self._failure_window:
+                    state.failures.popleft()
+                if len(state.failures) >= self._failure_threshold:
+                    state.opened_at = now
+                    state.failures.clear()
+
+    def is_open(self, host):
+        """Return whether ``host``'s circuit is open (or half-open)."""
+        with self._lock:
+            state = self._hosts.get(host)
+            return state is not None and state.opened_at is not None
+
+
+class _HostState:
+    def __init__(self):
+        self.failures = deque()
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.in_flight = 0
+
+
+class ProbeSession:
+    """
+    A long-lived HTTP session for page probes, one per worker process.
+
+    Connections are kept alive and reused so that repeatedly probing pages on
+    the same host doesn't pay for a new TCP and TLS handshake every time.
+    Connection pools are kept for up to ``pool_connections`` hosts, each
+    holding up to ``pool_maxsize`` idle connections.
+    """
+
+    def __init__(self, pool_connections=100, pool_maxsize=4):
+        self._pool_connections = pool_connections
+        self._pool_maxsize = pool_maxsize
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    def get(self, url, **kwargs):
+        """Make a GET request, see :py:meth:`requests.Session.get`."""
+        return self._get_session().get(url, **kwargs)
+
+    def _get_session(self):
+        with self._lock:
+            # A forked child process can't use the connections it inherited
+            # from its parent, so it gets a new session. The inherited one is
+            # dropped without being closed, closing it would shut down the
+            # parent's connections.
+            if self._pid != os.getpid():
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self._pool_connections,
+                    pool_maxsize=self._pool_maxsize,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                # Don't send cookies set by one page to the next.
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+                self._session = session
+                self._pid = os.getpid()
+
+            return self._session
+
+
+#: Strings whose presence in a page's HTML shows that it embeds the client.
+EMBEDDED_CLIENT_MARKERS = (
+    b"hypothes.is/embed.js",
+    b"cdn.hypothes.is/hypothesis",
+    b"js-hypothesis-config",
+)
+
+#: The default maximum number of bytes of a page to search for the markers.
+MAX_BYTES_TO_CHECK = 512 * 1024
+
+_MARKERS = b"|".join(re.escape(marker) for marker in EMBEDDED_CLIENT_MARKERS)
+_MARKERS_PATTERN = re.compile(b"(?P<marker>" + _MARKERS + b")")
+_MARKERS_OR_HEAD_END_PATTERN = re.compile(
+    b"(?P<marker>" + _MARKERS + b")|(?P<head_end>(?i:</head>))"
+)
+_PROBE_TIMEOUT = 1.5
+_PROBE_CHUNK_SIZE = 16 * 1024
+_PROBE_HEADERS = {"User-Agent": "Hypothesis/1.0 (bouncer)"}
+
+# How many bytes of the end of one chunk need to be searched again with the
+# next, to find matches that span the two.
+_OVERLAP = max(len(marker) for marker in EMBEDDED_CLIENT_MARKERS + (b"</head>",)) - 1
+
+
+class MarkerScanner:
+    """
+    Searches the chunks of a page for any of ``EMBEDDED_CLIENT_MARKERS``.
+
+    The chunks of bytes are searched in a single pass as they're fed in,
+    without being decoded, and markers that span two chunks are found.
+
+    :param max_bytes: stop searching after this many bytes
+    :param stop_at_head_end: stop searching at the first ``</head>`` tag
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES_TO_CHECK, stop_at_head_end=False):
+        self._pattern = (
+            _MARKERS_OR_HEAD_END_PATTERN if stop_at_head_end else _MARKERS_PATTERN
+        )
+        self._max_bytes = max_bytes
+        self._tail = b""
+
+    def feed(self, chunk):
+        """
+        Search the next ``chunk`` of the page.
+
+        Returns whether the page contains a marker once that's known, or
+        ``None`` if the rest of the page needs to be searched.
+        """
+        chunk = chunk[: self._max_bytes]
+        self._max_bytes -= len(chunk)
+
+        searched = self._tail + chunk
+        match = self._pattern.search(searched)
+        if match:
+            return match.lastgroup == "marker"
+
+        if self._max_bytes <= 0:
+            return False
+
+        self._tail = searched[-_OVERLAP:]
+        return None
+
+
+def contains_marker(chunks, max_bytes=MAX_BYTES_TO_CHECK, stop_at_head_end=False):
+    """
+    Return whether any of ``EMBEDDED_CLIENT_MARKERS`` occur in ``chunks``.
+
+    :param chunks: an iterable of byte strings, eg. a response's ``iter_content()``
+    :param max_bytes: stop searching after this many bytes
+    :param stop_at_head_end: stop searching at the first ``</head>`` tag
+    """
+    scanner = MarkerScanner(max_bytes, stop_at_head_end)
+
+    for chunk in chunks:
+        result = scanner.feed(chunk)
+        if result is not None:
+            return result
+
     return False
 
 
-# Cache up to 10,000 page-lookups, but never for more than 24 hours
-@cached(cache=TTLCache(maxsize=10000, ttl=86400))
-def page_embeds_client(page: str) -> bool:
+def page_embeds_client(
+    page: str,
+    limiter: ProbeLimiter = None,
+    session: ProbeSession = None,
+    max_bytes: int = MAX_BYTES_TO_CHECK,
+    stop_at_head_end: bool = False,
+) -> bool:
     """
     Checks if the client is embedded in provided page
     - Request is streamed to avoid trying to download a huge file unnecessarily
     - The page must be html to be evaluated. Anything else is ignored
     - We wait a maximum of 1.5 seconds for a response
-    - We will not evaluate more than 5000 lines of the response
+    - We will not evaluate more than ``max_bytes`` of the response, or beyond
+      the end of its ``<head>`` if ``stop_at_head_end`` is true
+
+    If a ``limiter`` is given the probe is counted against its limits and a
+    timeout, connection error or 5xx response is recorded as a failure of the
+    page's host.
+
+    The page is fetched using ``session`` if given, reusing its connections.
+
+    :raises HostUnavailableError: if ``limiter`` won't allow the page's host
+        to be probed
     """
 
-    request_timeout = 1.5
-    max_lines_to_check = 5000
-    embedded_client_markers = (
-        "hypothes.is/embed.js",
-        "cdn.hypothes.is/hypothesis",
-        "js-hypothesis-config",
-    )
-    headers = {"User-Agent": "Hypothesis/1.0 (bouncer)"}
+    host = urlparse(page).netloc
+    if limiter is not None:
+        limiter.acquire(host)
 
+    failed = False
     try:
-        with requests.get(
-            page, stream=True, timeout=request_timeout, headers=headers
+        http = session if session is not None else requests
+        with http.get(
+            page, stream=True, timeout=_PROBE_TIMEOUT, headers=_PROBE_HEADERS
         ) as r:
+            failed = r.status_code >= 500
             if (
                 r.status_code != 200
                 or "text/html" not in r.headers.get("Content-Type", "").lower()
             ):
                 return False
 
-            for line in r.iter_lines():
-                if not line:
-                    # filter out keep-alive new lines
-                    continue
+            return contains_marker(
+                r.iter_content(chunk_size=_PROBE_CHUNK_SIZE),
+                max_bytes=max_bytes,
+                stop_at_head_end=stop_at_head_end,
+            )
+    except requests.RequestException:
+        # The host timed out or couldn't be reached. Continue as if the client
+        # was not embedded in the page.
+        failed = True
+        return False
+    except Exception:
+        # If the request fails in any other way, we simply ignore the error
+        # and continue as if the client was not embedded in the page
+        return False
+    finally:
+        if limiter is not None:
+            limiter.release(host, failed)
 
-                max_lines_to_check -= 1
-                if max_lines_to_check <= 0:
-                    break
 
-                decoded_line = line.decode("utf-8")
-                if any(marker in decoded_line for marker in embedded_client_markers):
-                    return True
+async def page_embeds_client_async(
+    page: str,
+    client: httpx.AsyncClient,
+    limiter: ProbeLimiter = None,
+    max_bytes: int = MAX_BYTES_TO_CHECK,
+    stop_at_head_end: bool = False,
+) -> bool:
+    """
+    Check if the client is embedded in ``page`` without blocking the event loop.
+
+    The asyncio version of :py:func:`page_embeds_client`, which fetches the
+    page with ``client`` and is otherwise the same.
+
+    :raises HostUnavailableError: if ``limiter`` won't allow the page's host
+        to be probed
+    """
+    host = urlparse(page).netloc
+    if limiter is not None:
+        limiter.acquire(host)
+
+    failed = False
+    try:
+        async with client.stream(
+            "GET",
+            page,
+            timeout=_PROBE_TIMEOUT,
+            headers=_PROBE_HEADERS,
+            follow_redirects=True,
+        ) as r:
+            failed = r.status_code >= 500
+            if (
+                r.status_code != 200
+                or "text/html" not in r.headers.get("Content-Type", "").lower()
+            ):
+                return False
+
+            scanner = MarkerScanner(max_bytes, stop_at_head_end)
+            async for chunk in r.aiter_bytes(chunk_size=_PROBE_CHUNK_SIZE):
+                result = scanner.feed(chunk)
+                if result is not None:
+                    return result
+
+            return False
+    except httpx.TransportError:
+        failed = True
+        return False
     except Exception:
-        # If the request fails in any way, we simply ignore the error and
-        # continue as if the client was not embedded in the page
         return False
+    finally:
+        if limiter is not None:
+            limiter.release(host, failed)
 
-    return False
+
+def async_probe_client(max_connections=100):
+    """
+    Return an ``httpx.AsyncClient`` for :py:func:`page_embeds_client_async`.
+
+    Like :py:class:`ProbeSession` it never sends cookies to publishers.
+    """
+    return httpx.AsyncClient(
+        cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+        limits=httpx.Limits(max_connections=max_connections),
+    )
+
+
+class EmbedDetector:
+    """
+    Cached :py:func:`page_embeds_client` lookups.
+
+    Results are cached for up to ``cache_size`` pages, and are considered
+    fresh for ``cache_ttl`` seconds.
+
+    By default a page whose result isn't cached or has expired is checked
+    while the caller waits. In ``background`` mode pages are instead checked
+    by a pool of ``max_workers`` threads so that a slow page doesn't hold up
+    the request:
+
+    - An expired result is returned immediately while the page is re-checked
+      in the background (stale-while-revalidate).
+    - For a page with no cached result we wait at most ``cold_miss_timeout``
+      seconds for the check to finish. If it doesn't, the page is treated as
+      not embedding the client and the check finishes in the background so
+      that the next request for the page can use its result.
+    - At most ``max_queued`` pages can be waiting for, or in the middle of,
+      a background check. Pages beyond that aren't checked.
+
+    If a :py:class:`ProbeLimiter` is given, pages whose host it won't allow
+    to be probed are treated as not embedding the client, and that result
+    isn't cached.
+
+    Pages are fetched with ``session`` (a :py:class:`ProbeSession`) if given,
+    and ``max_bytes`` and ``stop_at_head_end`` limit how much of each page is
+    searched, see :py:func:`page_embeds_client`.
+
+    URLs are tested against the patterns of ``url_patterns`` (a
+    :py:class:`URLPatternMatcher`), if given, by :py:meth:`url_embeds_client`.
+
+    If a :py:class:`bouncer.shared_cache.SharedCache` is given it's used as a
+    second level cache, behind the in-process one, that's shared with the
+    other worker processes on the host. Pages are only checked if neither
+    cache has a fresh result.
+
+    It's safe to use from the threads of a threaded (gthread) gunicorn
+    worker. A page is only checked by one thread at a time, others that want
+    its result wait for that check instead of probing the page themselves.
+    """
+
+    def __init__(
+        self,
+        cache_size=10000,
+        cache_ttl=86400,
+        background=False,
+        max_workers=4,
+        max_queued=100,
+        cold_miss_timeout=0.1,
+        limiter=None,
+        session=None,
+        max_bytes=MAX_BYTES_TO_CHECK,
+        stop_at_head_end=False,
+        shared_cache=None,
+        url_patterns=None,
+        timer=time.monotonic,
+    ):
+        self._cache = LRUCache(maxsize=cache_size)
+        self._url_patterns = url_patterns
+        self._limiter = limiter
+        self._session = session
+        self._max_bytes = max_bytes
+        self._stop_at_head_end = stop_at_head_end
+        self._shared_cache = shared_cache
+        self._cache_ttl = cache_ttl
+        self._background = background
+        self._max_workers = max_workers
+        self._max_queued = max_queued
+        self._cold_miss_timeout = cold_miss_timeout
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_tasks = {}
+        self._checking = {}
+        # Created on first use so that no threads are started before
+        # gunicorn forks its workers.
+        self._executor = None
+
+    def url_embeds_client(self, url) -> bool:
+        """Return whether ``url`` is known to embed the client, see :py:func:`url_embeds_client`."""
+        return url_embeds_client(url, self._url_patterns)
+
+    def page_embeds_client(self, page: str) -> bool:
+        """Return whether ``page`` embeds the client, see :py:func:`page_embeds_client`."""
+        cached = self._get_cached(page)
+
+        if cached is not None:
+            embeds, checked_at = cached
+            if not self._expired(checked_at):
+                return embeds
+
+            if self._background:
+                self._check_in_background(page)
+                return embeds
+
+        if not self._background:
+            return self._check(page)
+
+        future = self._check_in_background(page)
+        if future is None:
+            return False
+
+        try:
+            return future.result(timeout=self._cold_miss_timeout)
+        except FutureTimeoutError:
+            return False
+
+    async def page_embeds_client_async(self, page: str, client) -> bool:
+        """
+        Return whether ``page`` embeds the client without blocking the event loop.
+
+        The asyncio version of :py:meth:`page_embeds_client`: pages are checked
+        by :py:func:`page_embeds_client_async` using the ``httpx.AsyncClient``
+        ``client``, in tasks on the event loop instead of in threads, and the
+        results are cached in the same way.
+        """
+        cached = self._get_cached(page)
+
+        if cached is not None:
+            embeds, checked_at = cached
+            if not self._expired(checked_at):
+                return embeds
+
+            if self._background:
+                self._check_async(page, client)
+                return embeds
+
+        task = self._check_async(page, client)
+        if task is None:
+            return False
+
+        # Shielded so that the check carries on if the caller gives up on it.
+        if not self._background:
+            return await asyncio.shield(task)
+
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(task), timeout=self._cold_miss_timeout
+            )
+        except asyncio.TimeoutError:
+            return False
+
+    def pages_embed_client(self, pages, timeout) -> dict:
+        """
+        Return a dict of whether each of ``pages`` embeds the client.
+
+        Pages without a fresh cached result are checked concurrently by the
+        background threads, whether or not in ``background`` mode, and we
+        wait at most ``timeout`` seconds for all of them to finish. Pages
+        whose checks don't finish in time get their expired cached result if
+        they have one and are otherwise treated as not embedding the client.
+        The checks finish in the background so that their results can be
+        used by later requests.
+        """
+        results = {}
+        futures = []
+
+        for page in set(pages):
+            cached = self._get_cached(page)
+            if cached is not None:
+                embeds, checked_at = cached
+                results[page] = embeds
+                if not self._expired(checked_at):
+                    continue
+
+            future = self._check_in_background(page)
+            if future is not None:
+                futures.append((page, future))
+
+        done, _ = wait([future for _, future in futures], timeout=timeout)
+        for page, future in futures:
+            if future in done:
+                results[page] = future.result()
+
+        return {page: results.get(page, False) for page in pages}
+
+    def _get_cached(self, page):
+        """Return the cached ``(embeds, checked_at)`` for ``page`` or ``None``."""
+        with self._lock:
+            cached = self._cache.get(page)
+
+        if self._shared_cache is not None and (
+            cached is None or self._expired(cached[1])
+        ):
+            # Another worker may have checked the page more recently.
+            shared = self._shared_cache.get(page)
+            if shared is not None:
+                embeds, age = shared
+                cached = (bool(embeds), self._timer() - age)
+                with self._lock:
+                    self._cache[page] = cached
+
+        return cached
+
+    def _expired(self, checked_at):
+        return self._timer() - checked_at >= self._cache_ttl
+
+    def _check(self, page):
+        """
+        Check ``page`` in this thread and return the result.
+
+        If another thread is already checking the page this waits for, and
+        returns, its result instead of probing the page again.
+        """
+        with self._lock:
+            future = self._checking.get(page)
+            if future is not None:
+                checking = False
+            else:
+                checking = True
+                future = self._checking[page] = Future()
+
+        if not checking:
+            return future.result()
+
+        try:
+            embeds = self._probe(page)
+            future.set_result(embeds)
+            return embeds
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self._lock:
+                del self._checking[page]
+
+    def _probe(self, page):
+        try:
+            embeds = page_embeds_client(
+                page,
+                limiter=self._limiter,
+                session=self._session,
+                max_bytes=self._max_bytes,
+                stop_at_head_end=self._stop_at_head_end,
+            )
+        except HostUnavailableError:
+            return False
+
+        self._store(page, embeds)
+        return embeds
+
+    def _store(self, page, embeds):
+        with self._lock:
+            self._cache[page] = (embeds, self._timer())
+
+        if self._shared_cache is not None:
+            self._shared_cache.set(page, embeds)
+
+    def _check_async(self, page, client):
+        """
+        Start checking ``page`` in an asyncio task and return the task.
+
+        Returns ``None`` if too many pages are already being checked.
+        """
+        with self._lock:
+            if page in self._pending_tasks:
+                return self._pending_tasks[page]
+
+            if len(self._pending_tasks) >= self._max_queued:
+                return None
+
+            task = asyncio.ensure_future(self._probe_async(page, client))
+            self._pending_tasks[page] = task
+
+        task.add_done_callback(lambda _: self._finished_async(page))
+        return task
+
+    async def _probe_async(self, page, client):
+        try:
+            embeds = await page_embeds_client_async(
+                page,
+                client,
+                limiter=self._limiter,
+                max_bytes=self._max_bytes,
+                stop_at_head_end=self._stop_at_head_end,
+            )
+        except HostUnavailableError:
+            return False
+
+        self._store(page, embeds)
+        return embeds
+
+    def _finished_async(self, page):
+        with self._lock:
+            self._pending_tasks.pop(page, None)
+
+    def _check_in_background(self, page):
+        """
+        Start checking ``page`` in the background and return the Future.
+
+        Returns ``None`` if too many pages are already queued.
+        """
+        with self._lock:
+            if page in self._pending:
+                return self._pending[page]
+
+            if len(self._pending) >= self._max_queued:
+                return None
+
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._max_workers,
+                    thread_name_prefix="embed_detector",
+                )
+
+            future = self._executor.submit(self._check, page)
+            self._pending[page] = future
+
+        future.add_done_callback(lambda _: self._finished(page))
+        return future
+
+    def _finished(self, page):
+        with self._lock:
+            self._pending.pop(page, None)
+
+
+def includeme(config):  # pragma: nocover
+    settings = config.registry.settings
+    settings.setdefault("embed_detector_background", False)
+    settings.setdefault("embed_detector_cache_size", 10000)
+    settings.setdefault("embed_detector_cache_ttl", 86400)
+    settings.setdefault("embed_detector_cold_miss_timeout", 0.1)
+    settings.setdefault("embed_detector_max_queued", 100)
+    settings.setdefault("embed_detector_max_workers", 4)
+    settings.setdefault("embed_detector_circuit_failure_threshold", 5)
+    settings.setdefault("embed_detector_circuit_failure_window", 60)
+    settings.setdefault("embed_detector_circuit_reset_timeout", 30)
+    settings.setdefault("embed_detector_max_bytes", MAX_BYTES_TO_CHECK)
+    settings.setdefault("embed_detector_max_probes", 20)
+    settings.setdefault("embed_detector_max_probes_per_host", 4)
+    settings.setdefault("embed_detector_patterns_file", PATTERNS_FILE)
+    settings.setdefault("embed_detector_pool_connections", 100)
+    settings.setdefault(
+        "embed_detector_pool_maxsize", settings["embed_detector_max_probes_per_host"]
+    )
+    settings.setdefault("embed_detector_shared_cache_path", None)
+    settings.setdefault("embed_detector_shared_cache_size", 100000)
+    settings.setdefault("embed_detector_stop_at_head_end", False)
+
+    shared_cache = None
+    if settings["embed_detector_shared_cache_path"]:
+        shared_cache = SharedCache(
+            settings["embed_detector_shared_cache_path"],
+            ttl=float(settings["embed_detector_cache_ttl"]),
+            maxsize=int(settings["embed_detector_shared_cache_size"]),
+        )
+
+    limiter = ProbeLimiter(
+        failure_threshold=int(settings["embed_detector_circuit_failure_threshold"]),
+        failure_window=float(settings["embed_detector_circuit_failure_window"]),
+        reset_timeout=float(settings["embed_detector_circuit_reset_timeout"]),
+        max_per_host=int(settings["embed_detector_max_probes_per_host"]),
+        max_total=int(settings["embed_detector_max_probes"]),
+    )
+
+    config.registry["embed_detector"] = EmbedDetector(
+        cache_size=int(settings["embed_detector_cache_size"]),
+        cache_ttl=float(settings["embed_detector_cache_ttl"]),
+        background=asbool(settings["embed_detector_background"]),
+        max_workers=int(settings["embed_detector_max_workers"]),
+        max_queued=int(settings["embed_detector_max_queued"]),
+        cold_miss_timeout=float(settings["embed_detector_cold_miss_timeout"]),
+        limiter=limiter,
+        session=ProbeSession(
+            pool_connections=int(settings["embed_detector_pool_connections"]),
+            pool_maxsize=int(settings["embed_detector_pool_maxsize"]),
+        ),
+        max_bytes=int(settings["embed_detector_max_bytes"]),
+        stop_at_head_end=asbool(settings["embed_detector_stop_at_head_end"]),
+        shared_cache=shared_cache,
+        url_patterns=URLPatternMatcher(
+            load_patterns(settings["embed_detector_patterns_file"])
+        ),
+    )
+    config.add_request_method(
+        lambda r: r.registry["embed_detector"], name="embed_detector", reify=True
+    )
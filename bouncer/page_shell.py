@@ -0,0 +1,144 @@
+import re
+import threading
+from importlib import resources
+
+from cachetools import LRUCache
+from markupsafe import escape
+from pyramid.renderers import render
+
+#: The template of the interstitial page that the shells are rendered from.
+TEMPLATE = "bouncer:templates/annotation.html.jinja2"
+
+#: The per-request fields of the page that are HTML-escaped when substituted.
+ESCAPED_FIELDS = ("pretty_url", "quote", "text")
+
+#: The per-request fields of the page that are substituted as they are.
+RAW_FIELDS = ("data", "title")
+
+#: Placeholders for the per-request fields. They must be left unchanged by
+#: HTML escaping and can't plausibly occur anywhere else in the page.
+_PLACEHOLDERS = {
+    field: f"BOUNCER_PAGE_SHELL_FIELD__{field}__"
+    for field in ESCAPED_FIELDS + RAW_FIELDS
+}
+
+_PLACEHOLDER_PATTERN = re.compile(
+    "("
+    + "|".join(re.escape(placeholder) for placeholder in _PLACEHOLDERS.values())
+    + ")"
+)
+
+_FIELDS_BY_PLACEHOLDER = {
+    placeholder: field for field, placeholder in _PLACEHOLDERS.items()
+}
+
+
+def minify_css(css):
+    """Return ``css`` with its comments and unnecessary whitespace removed."""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r" ?([{};,]) ?", r"\1", css)
+    return css.replace(";}", "}").strip()
+
+
+def minify_js(js):
+    """
+    Return ``js`` with its comment lines and indentation removed.
+
+    This is deliberately conservative so that it can't change what the script
+    does: only comments that take up whole lines are removed and line breaks
+    are kept so that automatic semicolon insertion still applies.
+    """
+    js = re.sub(r"^[ \t]*/\*.*?\*/[ \t]*$", "", js, flags=re.DOTALL | re.MULTILINE)
+    lines = (line.strip() for line in js.splitlines())
+    return "\n".join(line for line in lines if line and not line.startswith("//"))
+
+
+def _read_asset(path):
+    return resources.files("bouncer").joinpath(path).read_text(encoding="utf-8")
+
+
+class PageShell:
+    """
+    The interstitial page pre-rendered with placeholders for its dynamic fields.
+
+    Rendering a page from a shell is just a string join, so only the
+    per-request fields go through escaping and the template itself is only
+    rendered once.
+    """
+
+    def __init__(self, html):
+        parts = _PLACEHOLDER_PATTERN.split(html)
+        # ``parts`` alternates between static HTML and placeholders.
+        self._static = parts[::2]
+        self._fields = [_FIELDS_BY_PLACEHOLDER[part] for part in parts[1::2]]
+
+    def render(self, value):
+        """Return the page with the fields from the ``value`` dict substituted."""
+        html = [self._static[0]]
+        for field, static in zip(self._fields, self._static[1:]):
+            if field not in value:
+                # The same as Jinja rendering an undefined variable.
+                html.append("")
+            elif field in RAW_FIELDS:
+                html.append(str(value[field]))
+            else:
+                html.append(str(escape(value[field])))
+            html.append(static)
+        return "".join(html)
+
+
+class PageShellRenderer:
+    """
+    A Pyramid renderer for the interstitial page that uses :py:class:`PageShell`.
+
+    The page's CSS is inlined into it and its JavaScript is minified, so that
+    the browser doesn't have to make another request before it can redirect.
+
+    A shell is rendered for each application URL (the page contains absolute
+    URLs of static files), locale and for whether the page has social media
+    metadata.
+    In debug mode the shell is re-rendered for every request so that template
+    changes take effect immediately.
+    """
+
+    def __init__(self, info):
+        self._cache = not info.settings.get("debug")
+        self._css = minify_css(_read_asset("static/styles/bouncer.css"))
+        self._js = minify_js(_read_asset("scripts/redirect.js"))
+        self._shells = LRUCache(maxsize=16)
+        self._lock = threading.Lock()
+
+    def __call__(self, value, system):
+        request = system["request"]
+        show_metadata = value.get("show_metadata") == True  # noqa: E712
+        key = (request.application_url, request.locale_name, show_metadata)
+
+        with self._lock:
+            shell = self._shells.get(key)
+
+        if shell is None:
+            shell = self._render_shell(request, show_metadata)
+            if self._cache:
+                with self._lock:
+                    self._shells[key] = shell
+
+        return shell.render(value)
+
+    def _render_shell(self, request, show_metadata):
+        return PageShell(
+            render(
+                TEMPLATE,
+                {
+                    **_PLACEHOLDERS,
+                    "show_metadata": show_metadata,
+                    "inline_css": self._css,
+                    "inline_js": self._js,
+                },
+                request=request,
+            )
+        )
+
+
+def includeme(config):  # pragma: nocover
+    config.add_renderer("page_shell", PageShellRenderer)
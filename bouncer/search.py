@@ -1,4 +1,12 @@
-from elasticsearch import Elasticsearch
+import logging
+import threading
+import time
+from urllib.parse import quote
+
+import httpx
+from elasticsearch import Elasticsearch, exceptions
+
+log = logging.getLogger(__name__)
 
 
 def get_client(settings):
@@ -11,9 +19,169 @@ def get_client(settings):
     return Elasticsearch([host], **kwargs)
 
 
+class AsyncClient:
+    """
+    A minimal asyncio client for the few Elasticsearch requests bouncer makes.
+
+    The elasticsearch package that supports our servers has no asyncio
+    support, so this makes the requests with ``httpx``. Errors are raised as
+    the same ``elasticsearch.exceptions`` as the synchronous client raises so
+    that they can be handled in the same way.
+    """
+
+    def __init__(self, url, timeout=10, transport=None):
+        self._http = httpx.AsyncClient(
+            base_url=url, timeout=timeout, transport=transport
+        )
+
+    async def info(self):
+        return await self._request("/")
+
+    async def get(self, index, doc_type, id, params=None):
+        return await self._request(
+            f"/{quote(index, safe='')}/{quote(doc_type, safe='')}/{quote(id, safe='')}",
+            params,
+        )
+
+    async def cluster_health(self, index):
+        return await self._request(f"/_cluster/health/{quote(index, safe='')}")
+
+    async def aclose(self):
+        await self._http.aclose()
+
+    async def _request(self, path, params=None):
+        try:
+            response = await self._http.get(path, params=params)
+        except httpx.TransportError as exc:
+            raise exceptions.ConnectionError("N/A", str(exc), exc) from exc
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+
+        if response.status_code >= 400:
+            error = response.text
+            if isinstance(body, dict):
+                error = body.get("error", error)
+                if isinstance(error, dict) and "type" in error:
+                    error = error["type"]
+            raise exceptions.HTTP_EXCEPTIONS.get(
+                response.status_code, exceptions.TransportError
+            )(response.status_code, error, body)
+
+        return body
+
+
+class ServerVersion:
+    """
+    The cached major version of the Elasticsearch server.
+
+    The version is probed with ``es.info()`` the first time it's needed in
+    each worker process. After that the cached version is used, and it's
+    refreshed in a background thread once it's older than ``refresh_interval``
+    seconds or after :py:meth:`invalidate` has been called because a request
+    to Elasticsearch failed. The stale version continues to be used while the
+    refresh is in progress.
+    """
+
+    def __init__(self, client, refresh_interval):
+        self._client = client
+        self._refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._major = None
+        self._checked_at = None
+        self._refreshing = False
+
+    @property
+    def major(self) -> int:
+        """Return the major version of the Elasticsearch server."""
+        if self._major is None:
+            # There's no cached version to fall back on yet so we have no
+            # choice but to wait for the server's response.
+            self._refresh()
+        elif self._is_stale():
+            self._refresh_in_background()
+
+        return self._major
+
+    @property
+    def doc_type(self) -> str:
+        """
+        Return the ``doc_type`` to use when getting annotations.
+
+        This is the name of the mapping type used by h when talking to an ES 6
+        server, or the endpoint name "_doc" in ES 7+.
+
+        See https://www.elastic.co/guide/en/elasticsearch/reference/7.17/removal-of-types.html
+        """
+        return "_doc" if self.major >= 7 else "annotation"
+
+    @property
+    def source_includes_param(self) -> str:
+        """
+        Return the name of the query param for filtering the fields of ``_source``.
+
+        ES 7 removed the ``_source_include`` param in favour of ``_source_includes``.
+        """
+        return "_source_includes" if self.major >= 7 else "_source_include"
+
+    @property
+    def known(self) -> bool:
+        """Return whether the version has been probed, so using it won't block."""
+        return self._major is not None
+
+    def invalidate(self):
+        """Mark the cached version as stale so that it gets refreshed."""
+        with self._lock:
+            self._checked_at = None
+
+    def _is_stale(self):
+        with self._lock:
+            return (
+                self._checked_at is None
+                or time.monotonic() - self._checked_at >= self._refresh_interval
+            )
+
+    def _refresh(self):
+        server_version = self._client.info()["version"]["number"]
+        major, *_ = server_version.split(".")
+
+        with self._lock:
+            self._major = int(major)
+            self._checked_at = time.monotonic()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self._refresh()
+        except Exception:
+            # Keep using the stale version, the next request will try again.
+            log.warning("Failed to refresh the Elasticsearch version", exc_info=True)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
 def includeme(config):  # pragma: nocover
     settings = config.registry.settings
     settings.setdefault("elasticsearch_url", "http://localhost:9200")
+    settings.setdefault("elasticsearch_version_refresh_interval", 3600)
 
-    config.registry["es.client"] = get_client(settings)
+    client = get_client(settings)
+    config.registry["es.client"] = client
+    config.registry["es.version"] = ServerVersion(
+        client,
+        refresh_interval=float(settings["elasticsearch_version_refresh_interval"]),
+    )
     config.add_request_method(lambda r: r.registry["es.client"], name="es", reify=True)
+    config.add_request_method(
+        lambda r: r.registry["es.version"], name="es_version", reify=True
+    )
@@ -0,0 +1,121 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class SharedCache:
+    """
+    A key-value cache that's shared by all the worker processes on a host.
+
+    The cache is an SQLite database file, which should be on a RAM-backed
+    filesystem such as ``/dev/shm`` so that lookups are cheap. Values must be
+    types that SQLite can store: ints (including bools), floats or strings.
+
+    Entries expire ``ttl`` seconds after they were set, and once the cache
+    holds more than ``maxsize`` entries the oldest are deleted.
+
+    Errors talking to the database are logged and otherwise ignored: a
+    broken cache behaves like an empty one.
+    """
+
+    #: Purge expired and excess entries once every this many writes.
+    PURGE_INTERVAL = 100
+
+    def __init__(self, path, ttl, maxsize, timer=time.time):
+        self._path = path
+        self._ttl = ttl
+        self._maxsize = maxsize
+        # A wall clock time because timestamps are shared between processes.
+        self._timer = timer
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get(self, key):
+        """
+        Return ``(value, age)`` for ``key`` or ``None`` if it isn't cached.
+
+        ``age`` is the number of seconds since the value was set.
+        """
+        try:
+            row = (
+                self._connection()
+                .execute("SELECT value, set_at FROM cache WHERE key = ?", (key,))
+                .fetchone()
+            )
+        except sqlite3.Error:
+            log.warning("Failed to read from the shared cache", exc_info=True)
+            return None
+
+        if row is None:
+            return None
+
+        value, set_at = row
+        age = self._timer() - set_at
+        if age >= self._ttl:
+            return None
+
+        return value, age
+
+    def set(self, key, value):
+        """Set the cached ``value`` for ``key``."""
+        try:
+            connection = self._connection()
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, set_at) VALUES (?, ?, ?)",
+                    (key, value, self._timer()),
+                )
+
+            with self._lock:
+                self._writes += 1
+                purge = self._writes % self.PURGE_INTERVAL == 0
+
+            if purge:
+                self.purge()
+        except sqlite3.Error:
+            log.warning("Failed to write to the shared cache", exc_info=True)
+
+    def purge(self):
+        """Delete expired entries and the oldest entries over ``maxsize``."""
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "DELETE FROM cache WHERE set_at <= ?", (self._timer() - self._ttl,)
+            )
+            connection.execute(
+                """
+                DELETE FROM cache WHERE key IN (
+                    SELECT key FROM cache ORDER BY set_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self._maxsize,),
+            )
+
+    def _connection(self):
+        """Return this thread's connection to the database."""
+        # SQLite connections can't be shared between threads or carried
+        # across a fork, so each thread of each process gets its own.
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self._path, timeout=1)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            with connection:
+                connection.execute("""
+                    CREATE TABLE IF NOT EXISTS cache (
+                        key TEXT PRIMARY KEY,
+                        value,
+                        set_at REAL NOT NULL
+                    )
+                    """)
+                connection.execute(
+                    "CREATE INDEX IF NOT EXISTS cache_set_at ON cache (set_at)"
+                )
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return self._local.connection
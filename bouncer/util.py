@@ -22,6 +22,22 @@ ANNOTATION_BOILERPLATE_QUOTE = _("Hypothesis annotation")
 ANNOTATION_BOILERPLATE_TEXT = _("Follow this link to see the annotation in context")
 
 
+#: The fields of an annotation's Elasticsearch ``_source`` that
+#: :py:func:`parse_document` reads. Only these fields are fetched from
+#: Elasticsearch, so this must be kept in sync with :py:func:`parse_document`.
+DOCUMENT_FIELDS = (
+    "authority",
+    "deleted",
+    "document.web_uri",
+    "group",
+    "shared",
+    "target.selector.exact",
+    "target.selector.type",
+    "target.source",
+    "text",
+)
+
+
 class DeletedAnnotationError(Exception):
     """Raised if an annotation has been marked as deleted in Elasticsearch."""
 
@@ -1,23 +1,37 @@
+import hashlib
+import html
 import json
 from urllib import parse
 
 import h_pyramid_sentry
-from elasticsearch import Elasticsearch, exceptions
+from elasticsearch import exceptions
 from pyramid import httpexceptions, i18n, view
 from pyramid.httpexceptions import HTTPNoContent
 from sentry_sdk import capture_message
 
-from bouncer import util
-from bouncer.embed_detector import page_embeds_client, url_embeds_client
+from bouncer import annotation_cache, util
 
 _ = i18n.TranslationStringFactory(__package__)
 
 
+#: The headers of an HTTPError that are copied onto the error page's response.
+CACHE_HEADERS = ("Cache-Control", "Surrogate-Control", "Surrogate-Key")
+
+#: The settings that affect the content of annotation pages. They're part of
+#: the pages' ETags so that changing them invalidates cached pages.
+ETAG_SETTINGS = (
+    "chrome_extension_id",
+    "hypothesis_authority",
+    "version",
+    "via_base_url",
+)
+
+
 class FailedHealthcheck(Exception):
     """An exception raised when the healthcheck fails."""
 
 
-@view.view_defaults(renderer="bouncer:templates/annotation.html.jinja2")
+@view.view_defaults(renderer="page_shell")
 class AnnotationController(object):
     def __init__(self, request):
         self.request = request
@@ -27,106 +41,80 @@ class AnnotationController(object):
     def annotation(self):
         settings = self.request.registry.settings
 
-        try:
-            es7_or_later = _es_server_version(self.request.es) >= 7
-            document = self.request.es.get(
-                index=settings["elasticsearch_index"],
-                # Set `doc_type` to the name of the mapping type used by h
-                # when talking to an ES 6 server, or the endpoint name "_doc"
-                # in ES 7+.
-                #
-                # See https://www.elastic.co/guide/en/elasticsearch/reference/7.17/removal-of-types.html
-                doc_type="_doc" if es7_or_later else "annotation",
-                id=self.request.matchdict["id"],
-            )
-        except exceptions.NotFoundError:
-            raise httpexceptions.HTTPNotFound(_("Annotation not found"))
+        parsed_document = self._get_parsed_document()
 
-        try:
-            parsed_document = util.parse_document(document)
-            authority = parsed_document["authority"]
-            annotation_id = parsed_document["annotation_id"]
-            document_uri = parsed_document["document_uri"]
-            show_metadata = parsed_document["show_metadata"]
-            quote = parsed_document["quote"]
-            text = parsed_document["text"]
-            has_media_time = parsed_document["has_media_time"]
-
-        except util.DeletedAnnotationError:
-            raise httpexceptions.HTTPNotFound(_("Annotation not found"))
-
-        except util.InvalidAnnotationError as exc:
-            raise httpexceptions.HTTPUnprocessableEntity(str(exc))
-
-        # Remove any existing #fragment identifier from the URI before we
-        # append our own.
-        document_uri = parse.urldefrag(document_uri)[0]
-
-        if not _is_valid_http_url(document_uri):
-            raise httpexceptions.HTTPUnprocessableEntity(
-                _(
-                    "Sorry, but it looks like this annotation was made on a "
-                    "document that is not publicly available."
-                )
-            )
+        # Answer conditional requests before doing any of the expensive work
+        # of probing the annotated page and rendering our own.
+        etag = annotation_etag(settings, parsed_document)
+        if etag in self.request.if_none_match:
+            response = httpexceptions.HTTPNotModified()
+            set_cache_headers(self.request, response, etag=etag)
+            return response
 
-        via_url = None
-        if _can_use_proxy(settings, authority=authority) and not url_embeds_client(
-            document_uri
-        ):
-            via_url = "{via_base_url}/{uri}#annotations:{id}".format(
-                via_base_url=settings["via_base_url"],
-                uri=document_uri,
-                id=annotation_id,
-            )
+        redirect = get_redirect(settings, self.request.embed_detector, parsed_document)
 
-        extension_url = "{uri}#annotations:{id}".format(
-            uri=document_uri, id=annotation_id
-        )
+        is_client_embedded = False
+        if not redirect["always_use_via"]:
+            is_client_embedded = self.request.embed_detector.page_embeds_client(
+                redirect["document_uri"]
+            )
 
-        pretty_url = util.get_pretty_url(document_uri)
+        set_cache_headers(self.request, self.request.response, etag=etag)
 
-        title = util.get_boilerplate_quote(document_uri)
+        return annotation_page(parsed_document, redirect, is_client_embedded)
 
-        default_extension = settings["chrome_extension_id"]["default"]
-        extension_id = settings["chrome_extension_id"].get(authority, default_extension)
+    def _get_parsed_document(self):
+        """
+        Return the parsed Elasticsearch document for the requested annotation.
 
-        # If a YouTube annotation has a media time associated, this means it
-        # was made using Via's transcript annotation tool.
-        #
-        # This means we force the use of Via, even if the extension is
-        # installed.
-        always_use_via = False
-        if document_uri.startswith("https://www.youtube.com") and has_media_time:
-            always_use_via = True
+        Results are served from the annotation cache if possible, so that a
+        popular annotation doesn't cost an Elasticsearch request every time
+        its link is followed.
+        """
+        settings = self.request.registry.settings
+        cache = self.request.annotation_cache
+        annotation_id = self.request.matchdict["id"]
+
+        parsed_document = cache.get(annotation_id)
+
+        if parsed_document is None:
+            try:
+                document = self.request.es.get(
+                    index=settings["elasticsearch_index"],
+                    doc_type=self.request.es_version.doc_type,
+                    id=annotation_id,
+                    # Only fetch the parts of the annotation that we actually use.
+                    params={
+                        self.request.es_version.source_includes_param: ",".join(
+                            util.DOCUMENT_FIELDS
+                        )
+                    },
+                )
+            except exceptions.NotFoundError:
+                cache.set_missing(annotation_id, annotation_cache.NOT_FOUND)
+                raise self._not_found()
+            except exceptions.ElasticsearchException:
+                # The server may have been upgraded since we last checked its
+                # version, so check it again before the next request.
+                self.request.es_version.invalidate()
+                raise
 
-        is_client_embedded = not always_use_via and page_embeds_client(document_uri)
+            try:
+                parsed_document = parse_and_cache(cache, annotation_id, document)
+            except util.InvalidAnnotationError as exc:
+                raise httpexceptions.HTTPUnprocessableEntity(str(exc))
 
-        return {
-            "data": json.dumps(
-                {
-                    # Warning: variable names change from python_style to
-                    # javaScriptStyle here!
-                    "alwaysUseVia": always_use_via,
-                    "chromeExtensionId": extension_id,
-                    "extensionUrl": extension_url,
-                    "isClientEmbedded": is_client_embedded,
-                    "viaUrl": via_url,
-                }
-            ),
-            "show_metadata": show_metadata,
-            "pretty_url": pretty_url,
-            "quote": quote,
-            "text": text,
-            "title": title,
-        }
+        if parsed_document in (annotation_cache.NOT_FOUND, annotation_cache.DELETED):
+            raise self._not_found()
 
+        return parsed_document
 
-def _es_server_version(es: Elasticsearch) -> int:
-    """Return the major version of the Elasticsearch server."""
-    server_version = es.info()["version"]["number"]
-    major, *other = server_version.split(".")
-    return int(major)
+    def _not_found(self):
+        """Return the exception for an annotation that's missing or deleted."""
+        exc = httpexceptions.HTTPNotFound(_("Annotation not found"))
+        # ErrorController copies these onto the error page's response.
+        set_cache_headers(self.request, exc, not_found=True)
+        return exc
 
 
 @view.view_config(renderer="bouncer:templates/index.html.jinja2", route_name="index")
@@ -134,9 +122,7 @@ def index(request):  # pragma: nocover
     raise httpexceptions.HTTPFound(location=request.registry.settings["hypothesis_url"])
 
 
-@view.view_config(
-    renderer="bouncer:templates/annotation.html.jinja2", route_name="goto_url"
-)
+@view.view_config(renderer="page_shell", route_name="goto_url")
 def goto_url(request):
     """
     Redirect the user to a specified URL with the annotation client layer
@@ -181,7 +167,7 @@ def goto_url(request):
         # populate the client search with a query
         fragment = fragment + "query:{query}".format(query=query)
 
-    if not url_embeds_client(url):
+    if not request.embed_detector.url_embeds_client(url):
         via_url = "{via_base_url}/{url}#{fragment}".format(
             via_base_url=settings["via_base_url"], url=url, fragment=fragment
         )
@@ -206,6 +192,135 @@ def goto_url(request):
     }
 
 
+@view.view_config(route_name="resolve", renderer="json", request_method="POST")
+def resolve(request):
+    """
+    Return the redirect data of a batch of annotations.
+
+    This is the data that the annotations' pages would give redirect.js, plus
+    their share metadata, for integrations that need it for many annotations
+    at once. The request body is a JSON object with a list of annotation IDs:
+
+        {"ids": ["AVLlVTs1f9G3pW-EYc6q", ...]}
+
+    The response maps each ID to either its data or an error:
+
+        {"annotations": {"AVLlVTs1f9G3pW-EYc6q": {"viaUrl": ..., ...}, ...}}
+        {"annotations": {"missing": {"error": {"status": 404, "message": ...}}}}
+
+    Annotations that aren't cached are fetched with a single Elasticsearch
+    ``mget`` and the annotated pages are probed concurrently with a shared
+    deadline, see :py:meth:`bouncer.embed_detector.EmbedDetector.pages_embed_client`.
+    """
+    settings = request.registry.settings
+    cache = request.annotation_cache
+
+    try:
+        annotation_ids = request.json_body["ids"]
+    except (ValueError, TypeError, KeyError):
+        annotation_ids = None
+
+    if not isinstance(annotation_ids, list) or not all(
+        isinstance(annotation_id, str) and annotation_id
+        for annotation_id in annotation_ids
+    ):
+        request.response.status_int = 400
+        return {"error": 'The request body must be {"ids": [<annotation IDs>]}'}
+
+    max_ids = int(settings["resolve_max_ids"])
+    if len(annotation_ids) > max_ids:
+        request.response.status_int = 400
+        return {"error": f"At most {max_ids} annotation IDs can be resolved at once"}
+
+    # Remove duplicates but keep the order.
+    annotation_ids = list(dict.fromkeys(annotation_ids))
+
+    parsed_documents = {
+        annotation_id: cache.get(annotation_id) for annotation_id in annotation_ids
+    }
+    errors = {}
+
+    uncached_ids = [
+        annotation_id
+        for annotation_id, parsed_document in parsed_documents.items()
+        if parsed_document is None
+    ]
+    if uncached_ids:
+        try:
+            documents = request.es.mget(
+                body={"ids": uncached_ids},
+                index=settings["elasticsearch_index"],
+                doc_type=request.es_version.doc_type,
+                params={
+                    request.es_version.source_includes_param: ",".join(
+                        util.DOCUMENT_FIELDS
+                    )
+                },
+            )["docs"]
+        except exceptions.ElasticsearchException:
+            request.es_version.invalidate()
+            raise
+
+        for annotation_id, document in zip(uncached_ids, documents):
+            if "error" in document:
+                errors[annotation_id] = _resolve_error(
+                    502, _("Failed to fetch annotation")
+                )
+            elif not document.get("found"):
+                cache.set_missing(annotation_id, annotation_cache.NOT_FOUND)
+                parsed_documents[annotation_id] = annotation_cache.NOT_FOUND
+            else:
+                try:
+                    parsed_documents[annotation_id] = parse_and_cache(
+                        cache, annotation_id, document
+                    )
+                except util.InvalidAnnotationError as exc:
+                    errors[annotation_id] = _resolve_error(422, str(exc))
+
+    redirects = {}
+    for annotation_id, parsed_document in parsed_documents.items():
+        if annotation_id in errors:
+            continue
+        if parsed_document in (annotation_cache.NOT_FOUND, annotation_cache.DELETED):
+            errors[annotation_id] = _resolve_error(404, _("Annotation not found"))
+            continue
+        try:
+            redirects[annotation_id] = get_redirect(
+                settings, request.embed_detector, parsed_document
+            )
+        except httpexceptions.HTTPUnprocessableEntity as exc:
+            errors[annotation_id] = _resolve_error(422, str(exc))
+
+    embeds = request.embed_detector.pages_embed_client(
+        [
+            redirect["document_uri"]
+            for redirect in redirects.values()
+            if not redirect["always_use_via"]
+        ],
+        timeout=float(settings["resolve_probe_timeout"]),
+    )
+
+    results = {}
+    for annotation_id in annotation_ids:
+        if annotation_id in errors:
+            results[annotation_id] = errors[annotation_id]
+            continue
+
+        redirect = redirects[annotation_id]
+        parsed_document = parsed_documents[annotation_id]
+        is_client_embedded = embeds.get(redirect["document_uri"], False)
+        results[annotation_id] = {
+            **redirect_data(redirect, is_client_embedded),
+            "showMetadata": parsed_document["show_metadata"],
+            "quote": parsed_document["quote"],
+            "text": parsed_document["text"],
+            # The title is HTML for the page's <title>.
+            "title": html.unescape(redirect["title"]),
+        }
+
+    return {"annotations": results}
+
+
 @view.view_config(route_name="crash")
 def crash(request):  # pragma: nocover
     """Crash if requested to for testing purposes."""
@@ -227,6 +342,9 @@ class ErrorController(object):
     @view.view_config(context=httpexceptions.HTTPServerError)
     def httperror(self):
         self.request.response.status_int = self.exc.status_int
+        for name in CACHE_HEADERS:
+            if name in self.exc.headers:
+                self.request.response.headers[name] = self.exc.headers[name]
         # If code raises an HTTPError or HTTPServerError we assume this was
         # deliberately raised and:
         # 1. Show the user an error page including specific error message
@@ -274,6 +392,154 @@ def healthcheck(request):
     return {"status": "okay"}
 
 
+def set_cache_headers(request, response, etag=None, not_found=False):
+    """
+    Set the HTTP caching headers of the annotation page ``response``.
+
+    Pages are tagged with a surrogate key for their annotation so that an
+    edge cache can purge all of an annotation's pages at once.
+    """
+    settings = request.registry.settings
+    prefix = "annotation_page_not_found" if not_found else "annotation_page"
+
+    if settings[f"{prefix}_cache_control"]:
+        response.headers["Cache-Control"] = settings[f"{prefix}_cache_control"]
+    if settings[f"{prefix}_surrogate_control"]:
+        response.headers["Surrogate-Control"] = settings[f"{prefix}_surrogate_control"]
+    response.headers["Surrogate-Key"] = "annotation-" + parse.quote(
+        request.matchdict["id"], safe=""
+    )
+    if etag:
+        response.etag = (etag, False)
+
+
+def parse_and_cache(cache, annotation_id, document):
+    """
+    Parse and cache the Elasticsearch ``document`` of ``annotation_id``.
+
+    Returns the parsed annotation dict, or :py:data:`annotation_cache.DELETED`
+    if the annotation has been deleted. Invalid annotations aren't cached.
+
+    :raise util.InvalidAnnotationError: if the annotation is invalid
+    """
+    try:
+        parsed_document = util.parse_document(document)
+    except util.DeletedAnnotationError:
+        cache.set_missing(annotation_id, annotation_cache.DELETED)
+        return annotation_cache.DELETED
+
+    cache.set(annotation_id, parsed_document)
+    return parsed_document
+
+
+def get_redirect(settings, embed_detector, parsed_document):
+    """
+    Return a dict of where to send the user to see ``parsed_document``.
+
+    This is everything about the redirect except whether the annotated page
+    embeds the client, because probing the page is slow and callers have
+    their own ways of doing it. The page only needs probing if the returned
+    ``always_use_via`` is false.
+
+    :raise httpexceptions.HTTPUnprocessableEntity: if the annotated document
+        isn't publicly available
+    """
+    authority = parsed_document["authority"]
+    annotation_id = parsed_document["annotation_id"]
+
+    # Remove any existing #fragment identifier from the URI before we
+    # append our own.
+    document_uri = parse.urldefrag(parsed_document["document_uri"])[0]
+
+    if not _is_valid_http_url(document_uri):
+        raise httpexceptions.HTTPUnprocessableEntity(
+            _(
+                "Sorry, but it looks like this annotation was made on a "
+                "document that is not publicly available."
+            )
+        )
+
+    via_url = None
+    if _can_use_proxy(settings, authority=authority) and not (
+        embed_detector.url_embeds_client(document_uri)
+    ):
+        via_url = "{via_base_url}/{uri}#annotations:{id}".format(
+            via_base_url=settings["via_base_url"],
+            uri=document_uri,
+            id=annotation_id,
+        )
+
+    extension_url = "{uri}#annotations:{id}".format(uri=document_uri, id=annotation_id)
+
+    default_extension = settings["chrome_extension_id"]["default"]
+    extension_id = settings["chrome_extension_id"].get(authority, default_extension)
+
+    # If a YouTube annotation has a media time associated, this means it
+    # was made using Via's transcript annotation tool.
+    #
+    # This means we force the use of Via, even if the extension is
+    # installed.
+    always_use_via = False
+    if (
+        document_uri.startswith("https://www.youtube.com")
+        and parsed_document["has_media_time"]
+    ):
+        always_use_via = True
+
+    return {
+        "always_use_via": always_use_via,
+        "chrome_extension_id": extension_id,
+        "document_uri": document_uri,
+        "extension_url": extension_url,
+        "pretty_url": util.get_pretty_url(document_uri),
+        "title": util.get_boilerplate_quote(document_uri),
+        "via_url": via_url,
+    }
+
+
+def redirect_data(redirect, is_client_embedded):
+    """Return the settings for redirect.js from a :py:func:`get_redirect` dict."""
+    # Warning: variable names change from python_style to javaScriptStyle here!
+    return {
+        "alwaysUseVia": redirect["always_use_via"],
+        "chromeExtensionId": redirect["chrome_extension_id"],
+        "extensionUrl": redirect["extension_url"],
+        "isClientEmbedded": is_client_embedded,
+        "viaUrl": redirect["via_url"],
+    }
+
+
+def annotation_page(parsed_document, redirect, is_client_embedded):
+    """Return the template data of the page for ``parsed_document``."""
+    return {
+        "data": json.dumps(redirect_data(redirect, is_client_embedded)),
+        "show_metadata": parsed_document["show_metadata"],
+        "pretty_url": redirect["pretty_url"],
+        "quote": parsed_document["quote"],
+        "text": parsed_document["text"],
+        "title": redirect["title"],
+    }
+
+
+def annotation_etag(settings, parsed_document):
+    """
+    Return a weak ETag for the page of the annotation ``parsed_document``.
+
+    The ETag is weak because the page also depends on whether the annotated
+    page embeds the client, which isn't known until it has been probed.
+    """
+    content = json.dumps(
+        [[settings[name] for name in ETAG_SETTINGS], parsed_document],
+        sort_keys=True,
+    )
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _resolve_error(status, message):
+    """Return the result of an annotation that :py:func:`resolve` failed on."""
+    return {"error": {"status": status, "message": message}}
+
+
 def _is_valid_http_url(url):
     """
     Return `True` if `url` is a valid HTTP or HTTPS URL.
@@ -307,10 +573,19 @@ def _can_use_proxy(settings, authority):
 
 
 def includeme(config):  # pragma: nocover
+    settings = config.registry.settings
+    settings.setdefault("annotation_page_cache_control", "public, max-age=60")
+    settings.setdefault("annotation_page_surrogate_control", None)
+    settings.setdefault("annotation_page_not_found_cache_control", "public, max-age=30")
+    settings.setdefault("annotation_page_not_found_surrogate_control", None)
+    settings.setdefault("resolve_max_ids", 500)
+    settings.setdefault("resolve_probe_timeout", 2)
+
     config.add_route("index", "/")
     config.add_route("healthcheck", "/_status")
     config.add_route("crash", "/_crash")
     config.add_route("goto_url", "/go")
+    config.add_route("resolve", "/api/resolve")
     config.add_route("annotation_with_url", "/{id}/*url")
     config.add_route("annotation_without_url", "/{id}")
     config.scan(__name__)
@@ -1,2 +1,8 @@
 bind = "0.0.0.0:8000"
 worker_tmp_dir = "/dev/shm"
+
+# Share the results of embed detection between all the workers on the host.
+# The cache lives in RAM (/dev/shm) next to gunicorn's worker heartbeat files.
+raw_env = [
+    "EMBED_DETECTOR_SHARED_CACHE_PATH=/dev/shm/bouncer-embed-detector.sqlite3",
+]
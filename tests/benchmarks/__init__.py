@@ -0,0 +1,19 @@
+"""
+Benchmarks for bouncer's hot paths.
+
+These aren't run as part of the test suite. Run a benchmark with, for example:
+
+    python -m tests.benchmarks.source_filtering
+"""
+
+import timeit
+
+
+def best_of(func, number=1000, repeat=5):
+    """Return the fastest time in seconds that one call to `func` took."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def print_row(name, *columns):
+    """Print one row of a benchmark's results table."""
+    print(f"{name:<40}" + "".join(f"{column:>20}" for column in columns))
@@ -0,0 +1,235 @@
+"""
+Compare serving annotation pages with sync gunicorn workers and with the ASGI app.
+
+Elasticsearch and the annotated pages are faked by a local server that is
+deliberately slow to respond, so that requests spend most of their time
+waiting on the network as they do in production. Each request is for a
+different annotation on a different page so that none of bouncer's caches
+help. The same number of worker processes is used for both modes:
+
+    python -m tests.benchmarks.async_serving
+"""
+
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from itertools import count
+
+import httpx
+
+from tests.benchmarks import print_row
+
+#: How long the fake Elasticsearch takes to respond, in seconds.
+ES_DELAY = 0.02
+
+#: How long the fake publishers' pages take to respond, in seconds.
+PAGE_DELAY = 0.2
+
+WORKERS = 2
+CONCURRENCY = 100
+DURATION = 10
+
+
+async def upstream(scope, receive, send):
+    """An ASGI app that fakes both Elasticsearch and the annotated pages."""
+    if scope["type"] != "http":
+        return
+
+    path = scope["path"]
+    if path.startswith("/page/"):
+        await asyncio.sleep(PAGE_DELAY)
+        content_type, body = b"text/html", b"<html><head></head><body></body></html>"
+    elif path.startswith("/hypothesis/_doc/"):
+        await asyncio.sleep(ES_DELAY)
+        annotation_id = path.rsplit("/", 1)[1]
+        server, port = scope["server"]
+        content_type, body = b"application/json", _document(
+            annotation_id, f"http://{server}:{port}/page/{annotation_id}"
+        )
+    else:
+        content_type, body = b"application/json", b'{"version": {"number": "7.10.0"}}'
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", content_type)],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def _document(annotation_id, uri):
+    return json.dumps(
+        {
+            "_id": annotation_id,
+            "found": True,
+            "_source": {
+                "authority": "localhost",
+                "group": "__world__",
+                "shared": True,
+                "text": "the text",
+                "target": [
+                    {
+                        "source": uri,
+                        "selector": [{"type": "TextQuoteSelector", "exact": "quote"}],
+                    }
+                ],
+            },
+        }
+    ).encode()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start(args, port, env=None):
+    """Start a server process with ``args`` and wait until it's listening on ``port``."""
+    process = subprocess.Popen(
+        args,
+        env={**os.environ, **(env or {})},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+
+    process.kill()
+    raise RuntimeError(f"{args[0]} didn't start")
+
+
+async def load(port, ids):
+    """
+    Request annotation pages from bouncer for ``DURATION`` seconds.
+
+    Returns the latencies of the requests, the number of errors, and how long
+    it took for all the requests to finish.
+    """
+    latencies = []
+    errors = 0
+    start_time = time.monotonic()
+    deadline = start_time + DURATION
+
+    async def user():
+        # A client per user, because httpx gets slow with a big shared pool.
+        async with httpx.AsyncClient(timeout=60) as client:
+            await requests(client)
+
+    async def requests(client):
+        nonlocal errors
+        while time.monotonic() < deadline:
+            request_start_time = time.monotonic()
+            try:
+                response = await client.get(f"http://127.0.0.1:{port}/a{next(ids)}")
+            except httpx.TransportError:
+                errors += 1
+                continue
+            latencies.append(time.monotonic() - request_start_time)
+            if response.status_code != 200:
+                errors += 1
+
+    await asyncio.gather(*(user() for _ in range(CONCURRENCY)))
+
+    return latencies, errors, time.monotonic() - start_time
+
+
+def run(name, args, port, env, ids):
+    process = start(args, port, env)
+    try:
+        latencies, errors, elapsed = asyncio.run(load(port, ids))
+    finally:
+        process.terminate()
+        process.wait()
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    print_row(
+        name,
+        f"{len(latencies) / elapsed:.0f}",
+        f"{quantiles[49] * 1e3:.0f}",
+        f"{quantiles[98] * 1e3:.0f}",
+        str(errors),
+    )
+
+
+def main():
+    upstream_port = free_port()
+    upstream_process = start(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "--port",
+            str(upstream_port),
+            "--log-level",
+            "warning",
+            "tests.benchmarks.async_serving:upstream",
+        ],
+        upstream_port,
+    )
+    env = {
+        "ELASTICSEARCH_URL": f"http://127.0.0.1:{upstream_port}",
+        # All the pages are on the same host, don't let that limit the probes.
+        "EMBED_DETECTOR_MAX_PROBES": "10000",
+        "EMBED_DETECTOR_MAX_PROBES_PER_HOST": "10000",
+    }
+    # Unique annotation IDs for all the requests of both runs.
+    ids = count()
+
+    try:
+        print_row("server", "requests/s", "p50 (ms)", "p99 (ms)", "errors")
+        port = free_port()
+        run(
+            f"gunicorn ({WORKERS} sync workers)",
+            [
+                sys.executable,
+                "-m",
+                "gunicorn",
+                "--workers",
+                str(WORKERS),
+                "--bind",
+                f"127.0.0.1:{port}",
+                "bouncer.app:create_app()",
+            ],
+            port,
+            env,
+            ids,
+        )
+        port = free_port()
+        run(
+            f"uvicorn ({WORKERS} ASGI workers)",
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "--factory",
+                "--workers",
+                str(WORKERS),
+                "--port",
+                str(port),
+                "--log-level",
+                "warning",
+                "bouncer.asgi:create_app",
+            ],
+            port,
+            env,
+            ids,
+        )
+    finally:
+        upstream_process.terminate()
+        upstream_process.wait()
+
+
+if __name__ == "__main__":
+    main()
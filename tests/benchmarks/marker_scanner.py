@@ -0,0 +1,89 @@
+"""
+Compare searching pages for the client's markers line by line and by chunk.
+
+The line by line search is the one page_embeds_client() used to do: split
+the response into lines, decode each one and check it for each marker, for
+up to 5000 lines. The chunked search is contains_marker():
+
+    python -m tests.benchmarks.marker_scanner
+"""
+
+import io
+
+import requests
+
+from bouncer.embed_detector import MAX_BYTES_TO_CHECK, contains_marker
+from tests.benchmarks import best_of, print_row
+
+MARKER = b'<script src="https://hypothes.is/embed.js"></script>'
+
+
+def response(body):
+    """Return a streamed requests Response with the given body."""
+    resp = requests.models.Response()
+    resp.raw = io.BytesIO(body)
+    return resp
+
+
+def line_by_line(resp):
+    markers = (
+        "hypothes.is/embed.js",
+        "cdn.hypothes.is/hypothesis",
+        "js-hypothesis-config",
+    )
+    max_lines_to_check = 5000
+    for line in resp.iter_lines():
+        if not line:
+            continue
+
+        max_lines_to_check -= 1
+        if max_lines_to_check <= 0:
+            break
+
+        decoded_line = line.decode("utf-8")
+        if any(marker in decoded_line for marker in markers):
+            return True
+
+    return False
+
+
+def chunked(resp):
+    return contains_marker(
+        resp.iter_content(chunk_size=16 * 1024), max_bytes=MAX_BYTES_TO_CHECK
+    )
+
+
+PAGES = {
+    "typical page, marker in <head>": (
+        b"<html><head>" + MARKER + b"</head><body>" + b"<p>Text.</p>\n" * 2000
+    ),
+    "typical page, marker at end": (
+        b"<html><head></head><body>" + b"<p>Text.</p>\n" * 2000 + MARKER
+    ),
+    "400KB minified page, no marker": b"<html><p>Text.</p>" * 20_000,
+    "400KB minified page, marker at end": b"<html><p>Text.</p>" * 20_000 + MARKER,
+    "2MB minified page, no marker": b"<html><p>Text.</p>" * 100_000,
+    "2MB page, 150k short lines": b"<p>Text.</p>\n" * 150_000,
+}
+
+
+def main():
+    print_row("page", "lines (ms)", "chunks (ms)")
+
+    for name, body in PAGES.items():
+        # Splitting a huge single line is so slow that it's only timed once.
+        number, repeat = (1, 1) if len(body) > 1_000_000 else (5, 5)
+        lines_result = line_by_line(response(body))
+        chunks_result = chunked(response(body))
+
+        print_row(
+            name,
+            f"{best_of(lambda: line_by_line(response(body)), number, repeat) * 1e3:.2f}"
+            + (" (found)" if lines_result else ""),
+            f"{best_of(lambda: chunked(response(body)), number, repeat) * 1e3:.2f}"
+            + (" (found)" if chunks_result else ""),
+        )
+
+
+if __name__ == "__main__":
+    main()
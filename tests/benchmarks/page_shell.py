@@ -0,0 +1,80 @@
+"""
+Compare rendering the interstitial page with Jinja and from a page shell.
+
+Prints the time taken to render the page and the size of the page, for the
+``goto_url`` page and an annotation page with social media metadata:
+
+    python -m tests.benchmarks.page_shell
+"""
+
+import json
+from unittest import mock
+
+from pyramid import testing
+from pyramid.renderers import render
+
+from bouncer import page_shell
+from tests.benchmarks import best_of, print_row
+
+PAGES = {
+    "goto_url": {
+        "data": json.dumps(
+            {
+                "chromeExtensionId": "bjfhmglciegochdpefhhlphglcehbmek",
+                "viaUrl": "https://via.hypothes.is/https://example.com/#annotations:query:",
+                "extensionUrl": "https://example.com/#annotations:query:",
+            }
+        ),
+        "pretty_url": "example.com",
+    },
+    "annotation": {
+        "data": json.dumps(
+            {
+                "alwaysUseVia": False,
+                "chromeExtensionId": "bjfhmglciegochdpefhhlphglcehbmek",
+                "extensionUrl": "https://example.com/#annotations:id",
+                "isClientEmbedded": False,
+                "viaUrl": "https://via.hypothes.is/https://example.com/#annotations:id",
+            }
+        ),
+        "show_metadata": True,
+        "pretty_url": "example.com",
+        "quote": "A quote from the <em>annotated</em> page " * 5,
+        "text": "The annotation's text & some more text " * 10,
+        "title": "Hypothesis annotation for example.com",
+    },
+}
+
+
+def main():
+    settings = {
+        "jinja2.directories": "bouncer:",
+        "jinja2.filters": {
+            "static_path": "pyramid_jinja2.filters:static_path_filter",
+            "static_url": "pyramid_jinja2.filters:static_url_filter",
+        },
+    }
+    request = testing.DummyRequest()
+
+    with testing.testConfig(request=request, settings=settings) as config:
+        config.include("pyramid_jinja2")
+        config.add_static_view(name="static", path="bouncer:static")
+        config.commit()
+
+        renderer = page_shell.PageShellRenderer(mock.Mock(settings={"debug": False}))
+
+        print_row("page", "bytes", "render (us)")
+        for name, value in PAGES.items():
+            html = render(page_shell.TEMPLATE, value, request=request)
+            seconds = best_of(
+                lambda: render(page_shell.TEMPLATE, value, request=request)
+            )
+            print_row(f"{name} (jinja)", len(html), f"{seconds * 1e6:.1f}")
+
+            html = renderer(value, {"request": request})
+            seconds = best_of(lambda: renderer(value, {"request": request}))
+            print_row(f"{name} (shell)", len(html), f"{seconds * 1e6:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Compare probing pages with a new connection each time and with ProbeSession.
+
+The pages are served by a local HTTPS server with a self-signed certificate
+(generated with the ``openssl`` command), so the difference is mostly the
+cost of the TCP and TLS handshakes that ProbeSession saves:
+
+    python -m tests.benchmarks.probe_session
+"""
+
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bouncer.embed_detector import ProbeSession, page_embeds_client
+from tests.benchmarks import best_of, print_row
+
+PAGE = b"<html><head></head><body><p>Hello world</p></body></html>"
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    # Allow keep-alive connections.
+    protocol_version = "HTTP/1.1"
+    # Don't let Nagle's algorithm delay the response on kept-alive connections.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(PAGE)))
+        self.end_headers()
+        self.wfile.write(PAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+def https_server(tmpdir):
+    """Start an HTTPS server on localhost and return it."""
+    certfile, keyfile = f"{tmpdir}/cert.pem", f"{tmpdir}/key.pem"
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=127.0.0.1",
+            "-addext",
+            "subjectAltName=IP:127.0.0.1",
+            "-keyout",
+            keyfile,
+            "-out",
+            certfile,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    # Make requests trust the self-signed certificate.
+    os.environ["REQUESTS_CA_BUNDLE"] = certfile
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        server = https_server(tmpdir)
+        page = f"https://127.0.0.1:{server.server_port}/page.html"
+        session = ProbeSession()
+
+        assert page_embeds_client(page) is False
+        assert page_embeds_client(page, session=session) is False
+
+        print_row("probe", "time (ms)")
+        print_row(
+            "new connection per probe",
+            f"{best_of(lambda: page_embeds_client(page), number=50) * 1e3:.2f}",
+        )
+        print_row(
+            "ProbeSession (keep-alive)",
+            f"{best_of(lambda: page_embeds_client(page, session=session), number=50) * 1e3:.2f}",
+        )
+
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
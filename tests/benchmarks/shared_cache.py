@@ -0,0 +1,71 @@
+"""
+Compare the cost of embed detection cache lookups with an outbound probe.
+
+The probe is made against a local HTTP server, so it's a lower bound on what
+a real probe of a publisher's page costs:
+
+    python -m tests.benchmarks.shared_cache
+"""
+
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bouncer.embed_detector import EmbedDetector, page_embeds_client
+from bouncer.shared_cache import SharedCache
+from tests.benchmarks import best_of, print_row
+
+PAGE = b"<html><head></head><body>" + b"<p>Hello world</p>" * 1000 + b"</body></html>"
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(PAGE)))
+        self.end_headers()
+        self.wfile.write(PAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    page = f"http://127.0.0.1:{server.server_port}/page.html"
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shared_cache = SharedCache(f"{tmpdir}/cache.sqlite3", ttl=86400, maxsize=1000)
+        shared_cache.set(page, False)
+
+        l1 = EmbedDetector()
+        l1.page_embeds_client(page)
+
+        print_row("lookup", "time (us)")
+        print_row(
+            "L1 hit (in-process)",
+            f"{best_of(lambda: l1.page_embeds_client(page)) * 1e6:.2f}",
+        )
+        print_row(
+            "L2 hit (shared SQLite)",
+            f"{best_of(lambda: shared_cache.get(page)) * 1e6:.2f}",
+        )
+        print_row(
+            "L1 miss, L2 hit",
+            f"{best_of(lambda: EmbedDetector(shared_cache=shared_cache).page_embeds_client(page)) * 1e6:.2f}",
+        )
+        print_row(
+            "L2 miss",
+            f"{best_of(lambda: shared_cache.get('http://example.com/missing')) * 1e6:.2f}",
+        )
+        print_row(
+            "outbound probe (localhost)",
+            f"{best_of(lambda: page_embeds_client(page), number=50) * 1e6:.2f}",
+        )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
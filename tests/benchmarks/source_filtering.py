@@ -0,0 +1,85 @@
+"""
+Compare fetching whole annotation documents with fetching only DOCUMENT_FIELDS.
+
+Prints the size of the Elasticsearch response and the time taken to decode
+and parse it, for progressively larger annotations:
+
+    python -m tests.benchmarks.source_filtering
+"""
+
+import json
+
+from bouncer import util
+from tests.benchmarks import best_of, print_row
+
+
+def es_response(text_length, selector_count, link_count, filtered):
+    """Return the JSON body of an Elasticsearch get response for an annotation."""
+    source = {
+        "authority": "hypothes.is",
+        "group": "__world__",
+        "shared": True,
+        "text": "x" * text_length,
+        "target": [
+            {
+                "source": "http://example.com/example.html",
+                "selector": [
+                    {"type": "TextQuoteSelector", "exact": "the quote"},
+                ]
+                + [
+                    {
+                        "type": "RangeSelector",
+                        "startContainer": f"/main[1]/p[{i}]",
+                        "endContainer": f"/main[1]/p[{i + 1}]",
+                        "startOffset": i,
+                        "endOffset": i + 10,
+                    }
+                    for i in range(selector_count)
+                ],
+            }
+        ],
+    }
+
+    if not filtered:
+        source["user"] = "acct:someone@hypothes.is"
+        source["tags"] = ["some", "tags"]
+        source["permissions"] = {"read": ["group:__world__"]}
+        source["document"] = {
+            "title": ["Example document"],
+            "link": [
+                {
+                    "href": f"http://example.com/example.html?link={i}",
+                    "rel": "alternate",
+                }
+                for i in range(link_count)
+            ],
+        }
+    else:
+        # Only the "type" and "exact" fields of selectors are fetched.
+        for selector in source["target"][0]["selector"]:
+            for key in list(selector):
+                if key not in ("type", "exact"):
+                    del selector[key]
+
+    return json.dumps({"_id": "annotation_id", "found": True, "_source": source})
+
+
+def main():
+    print_row("annotation", "bytes", "decode+parse (us)")
+
+    for text_length, selector_count, link_count in (
+        (100, 3, 5),
+        (10_000, 50, 100),
+        (100_000, 500, 1_000),
+    ):
+        for filtered in (False, True):
+            body = es_response(text_length, selector_count, link_count, filtered)
+            seconds = best_of(lambda: util.parse_document(json.loads(body)), number=100)
+
+            name = f"text={text_length} links={link_count}"
+            name += " (filtered)" if filtered else ""
+            print_row(name, len(body), f"{seconds * 1e6:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Compare matching URLs against a list of patterns one by one and by host index.
+
+The one by one match is what url_embeds_client() used to do: fullmatch()
+each compiled pattern in turn. The indexed match is URLPatternMatcher:
+
+    python -m tests.benchmarks.url_patterns
+"""
+
+import fnmatch
+import re
+
+from bouncer.embed_detector import PATTERNS_FILE, URLPatternMatcher, load_patterns
+from tests.benchmarks import best_of, print_row
+
+
+def patterns(count):
+    """Return `count` realistic publisher patterns, including the real ones."""
+    result = load_patterns(PATTERNS_FILE)
+    for i in range(count - len(result)):
+        if i % 10 == 0:
+            result.append(f"*.publisher{i}.org/reader/*")
+        elif i % 100 == 1:
+            result.append(f"journal{i}-??.example.com/*")
+        else:
+            result.append(f"www.publisher{i}.com/articles/*")
+    return result
+
+
+def one_by_one(compiled_patterns, netloc_and_path):
+    for pat in compiled_patterns:
+        if pat.fullmatch(netloc_and_path):
+            return True
+    return False
+
+
+URLS = {
+    "hit, exact host": ("www.publisher5.com", "/articles/1234"),
+    "hit, host suffix": ("reader.publisher10.org", "/reader/1234"),
+    "hit, real pattern": ("www.biorxiv.org", "/content/1234"),
+    "miss": ("www.example.com", "/some/article.html"),
+}
+
+
+def main():
+    print_row("patterns / url", "one by one (us)", "indexed (us)")
+
+    for count in (10, 100, 1_000, 10_000):
+        pattern_list = patterns(count)
+        compiled_patterns = [re.compile(fnmatch.translate(p)) for p in pattern_list]
+        matcher = URLPatternMatcher(pattern_list)
+
+        for name, (netloc, path) in URLS.items():
+            expected = one_by_one(compiled_patterns, netloc + path)
+            assert matcher.matches(netloc, path) is expected
+
+            print_row(
+                f"{count} / {name}",
+                f"{best_of(lambda: one_by_one(compiled_patterns, netloc + path), number=20) * 1e6:.2f}",
+                f"{best_of(lambda: matcher.matches(netloc, path)) * 1e6:.2f}",
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
 import functools
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
 import pytest
@@ -17,3 +20,34 @@ def autopatcher(request, target, **kwargs):
 @pytest.fixture
 def patch(request):
     return functools.partial(autopatcher, request)
+
+
+def hammerer(func, threads=16):
+    """
+    Call ``func(thread)`` from ``threads`` threads at once.
+
+    Exceptions raised in any of the threads are re-raised.
+    """
+    barrier = threading.Barrier(threads)
+
+    def run(thread):
+        barrier.wait()
+        func(thread)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(run, thread) for thread in range(threads)]
+        for future in futures:
+            future.result()
+
+
+@pytest.fixture
+def hammer():
+    """
+    Return a function that calls a function from many threads at once.
+
+    Threads are switched far more often than usual so that races show up.
+    """
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield hammerer
+    sys.setswitchinterval(switch_interval)
@@ -0,0 +1,63 @@
+from unittest.mock import Mock
+
+import pytest
+from elasticsearch import exceptions
+
+
+class TestAnnotation:
+    def test_it(self, app):
+        response = app.get("/AVLlVTs1f9G3pW-EYc6q", status=200)
+
+        assert response.content_type == "text/html"
+        assert "Loading annotation for example.com" in response.text
+        assert response.headers["Cache-Control"] == "public, max-age=60"
+        assert response.headers["Surrogate-Key"] == "annotation-AVLlVTs1f9G3pW-EYc6q"
+        assert response.headers["ETag"].startswith('W/"')
+
+    def test_it_answers_conditional_requests(self, app, page_embeds_client):
+        etag = app.get("/AVLlVTs1f9G3pW-EYc6q").headers["ETag"]
+        page_embeds_client.reset_mock()
+
+        response = app.get(
+            "/AVLlVTs1f9G3pW-EYc6q/https://example.com/",
+            headers={"If-None-Match": etag},
+            status=304,
+        )
+
+        assert response.body == b""
+        assert response.headers["ETag"] == etag
+        assert response.headers["Cache-Control"] == "public, max-age=60"
+        page_embeds_client.assert_not_called()
+
+    def test_it_when_the_annotation_is_not_found(self, app, Elasticsearch):
+        Elasticsearch.return_value.get.side_effect = exceptions.NotFoundError
+
+        response = app.get("/missing", status=404)
+
+        assert "Annotation not found" in response.text
+        assert response.headers["Cache-Control"] == "public, max-age=30"
+        assert response.headers["Surrogate-Key"] == "annotation-missing"
+        assert "ETag" not in response.headers
+
+    @pytest.fixture(autouse=True)
+    def Elasticsearch(self, patch):
+        Elasticsearch = patch("bouncer.search.Elasticsearch")
+        Elasticsearch.return_value.info = Mock(
+            return_value={"version": {"number": "7.10.0"}}
+        )
+        Elasticsearch.return_value.get = Mock(
+            return_value={
+                "_id": "AVLlVTs1f9G3pW-EYc6q",
+                "_source": {
+                    "authority": "localhost",
+                    "group": "__world__",
+                    "shared": True,
+                    "target": [{"source": "https://example.com/", "selector": []}],
+                },
+            }
+        )
+        return Elasticsearch
+
+    @pytest.fixture(autouse=True)
+    def page_embeds_client(self, patch):
+        return patch("bouncer.embed_detector.page_embeds_client", return_value=False)
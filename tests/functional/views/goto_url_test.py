@@ -0,0 +1,14 @@
+class TestGotoURL:
+    def test_it(self, app):
+        response = app.get("/go", params={"url": "https://example.com/?a=<b>"})
+
+        assert response.status_int == 200
+        assert response.content_type == "text/html"
+        # The page's CSS and JavaScript are inlined into it.
+        assert "<style>" in response.text
+        assert "export async function redirect(" in response.text
+        assert "bouncer.css" not in response.text
+        assert "Loading annotation for example.com</p>" in response.text
+        assert '"extensionUrl": "https://example.com/?a=<b>#annotations:query:"' in (
+            response.text
+        )
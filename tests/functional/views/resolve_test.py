@@ -0,0 +1,64 @@
+from unittest.mock import Mock
+
+import pytest
+
+
+class TestResolve:
+    def test_it(self, app):
+        response = app.post_json(
+            "/api/resolve", {"ids": ["AVLlVTs1f9G3pW-EYc6q", "missing"]}, status=200
+        )
+
+        assert response.json == {
+            "annotations": {
+                "AVLlVTs1f9G3pW-EYc6q": {
+                    "alwaysUseVia": False,
+                    "chromeExtensionId": "bjfhmglciegochdpefhhlphglcehbmek",
+                    "extensionUrl": "https://example.com/#annotations:AVLlVTs1f9G3pW-EYc6q",
+                    "isClientEmbedded": False,
+                    "viaUrl": "https://via.hypothes.is/https://example.com/#annotations:AVLlVTs1f9G3pW-EYc6q",
+                    "showMetadata": True,
+                    "quote": "Hypothesis annotation for example.com",
+                    "text": "The text",
+                    "title": "Hypothesis annotation for example.com",
+                },
+                "missing": {
+                    "error": {"status": 404, "message": "Annotation not found"}
+                },
+            }
+        }
+
+    def test_it_rejects_invalid_requests(self, app):
+        response = app.post("/api/resolve", "not json", status=400)
+
+        assert "error" in response.json
+
+    @pytest.fixture(autouse=True)
+    def Elasticsearch(self, patch):
+        Elasticsearch = patch("bouncer.search.Elasticsearch")
+        Elasticsearch.return_value.info = Mock(
+            return_value={"version": {"number": "7.10.0"}}
+        )
+        Elasticsearch.return_value.mget = Mock(
+            return_value={
+                "docs": [
+                    {
+                        "_id": "AVLlVTs1f9G3pW-EYc6q",
+                        "found": True,
+                        "_source": {
+                            "authority": "localhost",
+                            "group": "__world__",
+                            "shared": True,
+                            "text": "The text",
+                            "target": [{"source": "https://example.com/"}],
+                        },
+                    },
+                    {"_id": "missing", "found": False},
+                ]
+            }
+        )
+        return Elasticsearch
+
+    @pytest.fixture(autouse=True)
+    def page_embeds_client(self, patch):
+        return patch("bouncer.embed_detector.page_embeds_client", return_value=False)
@@ -0,0 +1,109 @@
+import pytest
+
+from bouncer.annotation_cache import DELETED, NOT_FOUND, AnnotationCache
+
+
+class TestAnnotationCache:
+    def test_get_returns_None_on_a_miss(self, cache):
+        assert cache.get("unknown_id") is None
+
+    def test_get_returns_cached_documents(self, cache, parsed_document):
+        cache.set("annotation_id", parsed_document)
+
+        assert cache.get("annotation_id") == parsed_document
+
+    @pytest.mark.parametrize("reason", [NOT_FOUND, DELETED])
+    def test_get_returns_cached_missing_annotations(self, cache, reason):
+        cache.set_missing("annotation_id", reason)
+
+        assert cache.get("annotation_id") == reason
+
+    def test_documents_expire_after_ttl(self, cache, clock, parsed_document):
+        cache.set("annotation_id", parsed_document)
+
+        clock.now += 59
+        assert cache.get("annotation_id") == parsed_document
+        clock.now += 1
+        assert cache.get("annotation_id") is None
+
+    def test_missing_annotations_expire_after_negative_ttl(self, cache, clock):
+        cache.set_missing("annotation_id", NOT_FOUND)
+
+        clock.now += 10
+        assert cache.get("annotation_id") is None
+
+    def test_it_evicts_entries_when_full(self, cache, parsed_document):
+        for i in range(4):
+            cache.set(f"id_{i}", parsed_document)
+
+        assert cache.get("id_0") is None
+        assert cache.stats()["evictions"] == 1
+        assert cache.stats()["size"] == 3
+
+    def test_missing_annotations_dont_evict_documents(self, cache, parsed_document):
+        cache.set("annotation_id", parsed_document)
+
+        for i in range(10):
+            cache.set_missing(f"missing_{i}", NOT_FOUND)
+
+        assert cache.get("annotation_id") == parsed_document
+
+    def test_stats(self, cache, parsed_document):
+        cache.set("annotation_id", parsed_document)
+        cache.set_missing("missing_id", DELETED)
+
+        cache.get("annotation_id")
+        cache.get("missing_id")
+        cache.get("unknown_id")
+
+        assert cache.stats() == {
+            "size": 1,
+            "negative_size": 1,
+            "hits": 2,
+            "misses": 1,
+            "evictions": 0,
+        }
+
+    def test_maxsize_0_disables_caching(self, clock, parsed_document):
+        cache = AnnotationCache(maxsize=0, ttl=60, negative_ttl=10, timer=clock)
+
+        cache.set("annotation_id", parsed_document)
+        cache.set_missing("missing_id", NOT_FOUND)
+
+        assert cache.get("annotation_id") is None
+        assert cache.get("missing_id") is None
+
+    def test_it_is_thread_safe(self, hammer, parsed_document):
+        cache = AnnotationCache(maxsize=10, ttl=60, negative_ttl=10)
+
+        def use_cache(thread):
+            for i in range(1000):
+                # Overlapping keys so that threads evict each other's entries.
+                key = str((thread + i) % 50)
+                cache.get(key)
+                cache.set(key, parsed_document)
+                cache.set_missing(f"missing_{key}", NOT_FOUND)
+
+        hammer(use_cache)
+
+        stats = cache.stats()
+        assert stats["hits"] + stats["misses"] == 16 * 1000
+        assert stats["size"] == stats["negative_size"] == 10
+
+    @pytest.fixture
+    def clock(self):
+        class Clock:
+            now = 0.0
+
+            def __call__(self):
+                return self.now
+
+        return Clock()
+
+    @pytest.fixture
+    def cache(self, clock):
+        return AnnotationCache(maxsize=3, ttl=60, negative_ttl=10, timer=clock)
+
+    @pytest.fixture
+    def parsed_document(self):
+        return {"annotation_id": "annotation_id"}
@@ -4,7 +4,7 @@ from unittest import mock
 import pytest
 from pyramid.config import Configurator
 
-from bouncer.app import create_app
+from bouncer.app import OPTIONAL_SETTINGS, create_app
 
 
 def test_the_default_settings(config, pyramid):
@@ -68,6 +68,16 @@ def test_via_base_url(config, os, envvar, base_url, pyramid):
     assert settings["via_base_url"] == base_url
 
 
+@pytest.mark.parametrize("setting", OPTIONAL_SETTINGS)
+def test_optional_settings(config, os, setting, pyramid):
+    os.environ[setting.upper()] = "the_value"
+
+    create_app()
+
+    settings = pyramid.config.Configurator.call_args_list[0][1]["settings"]
+    assert settings[setting] == "the_value"
+
+
 @pytest.fixture
 def config():
     config = mock.create_autospec(Configurator, instance=True)
@@ -0,0 +1,285 @@
+import asyncio
+import logging
+from unittest.mock import Mock
+
+import httpx
+import pytest
+
+from bouncer import app, asgi, search, util
+
+ANNOTATION_ID = "AVLlVTs1f9G3pW-EYc6q"
+
+DOCUMENT = {
+    "_id": ANNOTATION_ID,
+    "found": True,
+    "_source": {
+        "authority": "localhost",
+        "group": "__world__",
+        "shared": True,
+        "text": "The text",
+        "target": [{"source": "https://example.com/page"}],
+    },
+}
+
+
+class TestAsyncApp:
+    def test_annotation(self, asgi_app, es):
+        response = get(asgi_app, f"/{ANNOTATION_ID}")
+
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "text/html; charset=UTF-8"
+        assert "Loading annotation for example.com" in response.text
+        assert '"isClientEmbedded": true' in response.text
+        assert response.headers["Cache-Control"] == "public, max-age=60"
+        assert response.headers["ETag"].startswith('W/"')
+        assert es.requests == [
+            f"/hypothesis/_doc/{ANNOTATION_ID}?_source_includes="
+            + "%2C".join(util.DOCUMENT_FIELDS)
+        ]
+
+    def test_annotation_uses_the_annotation_cache(self, asgi_app, es):
+        get(asgi_app, f"/{ANNOTATION_ID}/https://example.com/page")
+        response = get(asgi_app, f"/{ANNOTATION_ID}/https://example.com/page")
+
+        assert response.status_code == 200
+        assert len(es.requests) == 1
+
+    def test_annotation_only_probes_the_elasticsearch_version_once(
+        self, asgi_app, Elasticsearch
+    ):
+        get(asgi_app, f"/{ANNOTATION_ID}")
+        get(asgi_app, "/another_id")
+
+        Elasticsearch.return_value.info.assert_called_once_with()
+
+    def test_annotation_caches_embed_detection(self, asgi_app, pages):
+        get(asgi_app, f"/{ANNOTATION_ID}")
+        get(asgi_app, f"/{ANNOTATION_ID}")
+
+        assert pages.requests == ["https://example.com/page"]
+
+    def test_annotation_answers_conditional_requests(self, asgi_app, pages):
+        etag = get(asgi_app, f"/{ANNOTATION_ID}").headers["ETag"]
+
+        response = get(asgi_app, f"/{ANNOTATION_ID}", headers={"If-None-Match": etag})
+
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["ETag"] == etag
+        assert response.headers["Surrogate-Key"] == f"annotation-{ANNOTATION_ID}"
+
+    def test_annotation_skips_probing_for_via_only_annotations(
+        self, asgi_app, es, pages
+    ):
+        es.document["_source"]["target"] = [
+            {
+                "source": "https://www.youtube.com/watch?v=1",
+                "selector": [{"type": "MediaTimeSelector"}],
+            }
+        ]
+
+        response = get(asgi_app, f"/{ANNOTATION_ID}")
+
+        assert '"alwaysUseVia": true' in response.text
+        assert pages.requests == []
+
+    def test_missing_annotations_are_handled_by_the_wsgi_app(self, asgi_app, es):
+        es.document = None
+
+        response = get(asgi_app, f"/{ANNOTATION_ID}")
+
+        assert response.status_code == 404
+        assert "Annotation not found" in response.text
+        assert response.headers["Cache-Control"] == "public, max-age=30"
+        # The WSGI app found the missing annotation in the annotation cache.
+        assert len(es.requests) == 1
+
+    def test_deleted_annotations_are_handled_by_the_wsgi_app(self, asgi_app, es):
+        es.document["_source"]["deleted"] = True
+
+        response = get(asgi_app, f"/{ANNOTATION_ID}")
+
+        assert response.status_code == 404
+
+    @pytest.mark.parametrize("target", [[], [{"source": "file:///home/user/file.pdf"}]])
+    def test_invalid_annotations_are_handled_by_the_wsgi_app(
+        self, asgi_app, es, Elasticsearch, target
+    ):
+        es.document["_source"]["target"] = target
+        Elasticsearch.return_value.get = Mock(return_value=es.document)
+
+        response = get(asgi_app, f"/{ANNOTATION_ID}")
+
+        assert response.status_code == 422
+
+    def test_elasticsearch_errors_are_handled_by_the_wsgi_app(
+        self, asgi_app, es, Elasticsearch
+    ):
+        es.status_code = 500
+        Elasticsearch.return_value.get = Mock(return_value=DOCUMENT)
+
+        response = get(asgi_app, f"/{ANNOTATION_ID}")
+
+        assert response.status_code == 200
+        Elasticsearch.return_value.get.assert_called_once()
+
+    def test_unexpected_errors_are_handled_by_the_wsgi_app(
+        self, asgi_app, es, Elasticsearch, caplog
+    ):
+        es.document = {"unexpected": "response"}
+        Elasticsearch.return_value.get = Mock(return_value=DOCUMENT)
+
+        with caplog.at_level(logging.ERROR):
+            response = get(asgi_app, f"/{ANNOTATION_ID}")
+
+        assert response.status_code == 200
+        assert "Async handler failed" in caplog.text
+
+    def test_goto_url(self, asgi_app):
+        response = get(asgi_app, "/go?url=https://example.com/")
+
+        assert response.status_code == 200
+        assert "Loading annotation for example.com" in response.text
+
+    def test_goto_url_errors_are_handled_by_the_wsgi_app(self, asgi_app):
+        response = get(asgi_app, "/go")
+
+        assert response.status_code == 400
+        assert '"url" parameter is missing' in response.text
+
+    def test_healthcheck(self, asgi_app):
+        response = get(asgi_app, "/_status")
+
+        assert response.status_code == 200
+        assert response.json() == {"status": "okay"}
+        assert (
+            response.headers["Cache-Control"]
+            == "max-age=0, must-revalidate, no-cache, no-store"
+        )
+
+    @pytest.mark.parametrize("es_status,health", [(500, "green"), (200, "red")])
+    def test_failed_healthchecks_are_handled_by_the_wsgi_app(
+        self, asgi_app, es, Elasticsearch, es_status, health
+    ):
+        es.status_code = es_status
+        es.health = health
+        Elasticsearch.return_value.cluster.health.return_value = {"status": "red"}
+
+        response = get(asgi_app, "/_status")
+
+        assert response.status_code == 500
+        Elasticsearch.return_value.cluster.health.assert_called_once()
+
+    def test_healthcheck_sentry_messages_are_sent_by_the_wsgi_app(
+        self, asgi_app, Elasticsearch
+    ):
+        response = get(asgi_app, "/_status?sentry")
+
+        assert response.status_code == 200
+        Elasticsearch.return_value.cluster.health.assert_called_once()
+
+    def test_other_requests_are_handled_by_the_wsgi_app(self, asgi_app):
+        response = get(asgi_app, "/static/styles/bouncer.css")
+
+        assert response.status_code == 200
+        assert "spinner" in response.text
+
+    def test_non_get_requests_are_handled_by_the_wsgi_app(self, asgi_app):
+        async def request():
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=asgi_app),
+                base_url="http://localhost",
+            ) as client:
+                return await client.post("/api/resolve", content=b"not json")
+
+        response = asyncio.run(request())
+
+        assert response.status_code == 400
+
+    def test_lifespan(self, asgi_app):
+        sent = []
+        messages = iter([{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}])
+
+        async def receive():
+            return next(messages)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(asgi_app({"type": "lifespan"}, receive, send))
+
+        assert sent == [
+            {"type": "lifespan.startup.complete"},
+            {"type": "lifespan.shutdown.complete"},
+        ]
+
+    @pytest.fixture
+    def asgi_app(self, es, pages):
+        return asgi.AsyncApp(
+            app.create_app(),
+            es_client=search.AsyncClient(
+                "http://es.example.com", transport=httpx.MockTransport(es)
+            ),
+            probe_client=httpx.AsyncClient(transport=httpx.MockTransport(pages)),
+        )
+
+    @pytest.fixture
+    def es(self):
+        return FakeElasticsearch()
+
+    @pytest.fixture
+    def pages(self):
+        def pages(request):
+            pages.requests.append(str(request.url))
+            return httpx.Response(
+                200,
+                headers={"Content-Type": "text/html"},
+                content=b'<script src="https://hypothes.is/embed.js"></script>',
+            )
+
+        pages.requests = []
+        return pages
+
+    @pytest.fixture(autouse=True)
+    def Elasticsearch(self, patch):
+        # The synchronous client used by the WSGI app and for the version probe.
+        Elasticsearch = patch("bouncer.search.Elasticsearch")
+        Elasticsearch.return_value.info = Mock(
+            return_value={"version": {"number": "7.10.0"}}
+        )
+        Elasticsearch.return_value.get = Mock(side_effect=AssertionError)
+        Elasticsearch.return_value.cluster = Mock()
+        Elasticsearch.return_value.cluster.health.return_value = {"status": "green"}
+        return Elasticsearch
+
+
+class FakeElasticsearch:
+    """An httpx.MockTransport handler that pretends to be Elasticsearch."""
+
+    def __init__(self):
+        self.document = {**DOCUMENT, "_source": dict(DOCUMENT["_source"])}
+        self.health = "green"
+        self.status_code = 200
+        self.requests = []
+
+    def __call__(self, request):
+        if self.status_code != 200:
+            return httpx.Response(self.status_code, json={"error": "oops"})
+
+        if request.url.path.startswith("/_cluster/health/"):
+            return httpx.Response(200, json={"status": self.health})
+
+        self.requests.append(f"{request.url.path}?{request.url.query.decode()}")
+        if self.document is None:
+            return httpx.Response(404, json={"_id": ANNOTATION_ID, "found": False})
+        return httpx.Response(200, json=self.document)
+
+
+def get(asgi_app, path, headers=None):
+    async def request():
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=asgi_app), base_url="http://localhost"
+        ) as client:
+            return await client.get(path, headers=headers)
+
+    return asyncio.run(request())
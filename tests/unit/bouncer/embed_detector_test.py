@@ -1,9 +1,30 @@
+import asyncio
+import os
 import secrets
-from unittest.mock import MagicMock, patch
+import threading
+from unittest.mock import MagicMock, create_autospec, patch
 
+import httpx
 import pytest
+import requests
 
-from bouncer.embed_detector import page_embeds_client, url_embeds_client
+from bouncer.embed_detector import (
+    MAX_BYTES_TO_CHECK,
+    PATTERNS_FILE,
+    EmbedDetector,
+    HostUnavailableError,
+    ProbeLimiter,
+    ProbeSession,
+    URLPatternMatcher,
+    async_probe_client,
+    contains_marker,
+    load_patterns,
+    page_embeds_client,
+    page_embeds_client_async,
+    url_embeds_client,
+)
+from bouncer.shared_cache import SharedCache
+from tests.conftest import hammerer
 
 
 class TestUrlEmbedsClient:
@@ -68,22 +89,42 @@ class TestUrlEmbedsClient:
         ],
     )
     def test_page_embeds_client_for_embedded_client(self, content_block):
-        # Add an empty line to cover logic to ignore empty lines
-        mock_get = response_mock(["<html>", None, content_block, "</html>"])
+        mock_get = response_mock(["<html>", "", content_block, "</html>"])
         with patch("bouncer.embed_detector.requests.get", return_value=mock_get):
             assert page_embeds_client(random_string_urlsafe()) is True
 
-    def test_page_embeds_client_for_too_many_lines(self):
-        lines = (
-            ["<html>"]
-            + ["some line" for _ in range(5000)]
-            # This would usually match, but it's further down the maximum amount of lines
-            + ['<script src="https://hypothes.is/embed.js"></script>', "</html>"]
-        )
-        mock_get = response_mock(lines)
+    def test_page_embeds_client_for_too_many_bytes(self):
+        chunks = [
+            "<html>" + "x" * (MAX_BYTES_TO_CHECK - len("<html>")),
+            # This would usually match, but it's beyond the maximum amount of bytes
+            '<script src="https://hypothes.is/embed.js"></script>',
+            "</html>",
+        ]
+        mock_get = response_mock(chunks)
         with patch("bouncer.embed_detector.requests.get", return_value=mock_get):
             assert page_embeds_client(random_string_urlsafe()) is False
 
+    def test_page_embeds_client_passes_the_limits_to_contains_marker(self):
+        mock_get = response_mock(
+            ["<html><head></head>", '<script class="js-hypothesis-config">']
+        )
+        with patch("bouncer.embed_detector.requests.get", return_value=mock_get):
+            assert (
+                page_embeds_client(
+                    random_string_urlsafe(), max_bytes=100, stop_at_head_end=True
+                )
+                is False
+            )
+
+    def test_page_embeds_client_for_non_utf8_page(self):
+        mock_get = response_mock([])
+        mock_get.__enter__.return_value.iter_content.return_value = [
+            "<html>é".encode("latin-1"),
+            b'<script class="js-hypothesis-config"></script>',
+        ]
+        with patch("bouncer.embed_detector.requests.get", return_value=mock_get):
+            assert page_embeds_client(random_string_urlsafe()) is True
+
     def test_page_embeds_client_with_raised_error(self):
         with patch(
             "bouncer.embed_detector.requests.get", side_effect=RuntimeError("fail")
@@ -91,13 +132,1005 @@ class TestUrlEmbedsClient:
             assert page_embeds_client(random_string_urlsafe()) is False
 
 
+class TestURLPatternMatcher:
+    @pytest.mark.parametrize(
+        "netloc,path,expected",
+        [
+            # Exact hostnames.
+            ("example.com", "/articles/1", True),
+            ("example.com", "/other/1", False),
+            ("www.example.com", "/articles/1", False),
+            ("example.com", "/", True),
+            # Hostname suffixes.
+            ("www.example.org", "/reader/1", True),
+            ("a.b.example.org", "/reader/1", True),
+            (".example.org", "/reader/1", True),
+            ("example.org", "/reader/1", False),
+            ("www.example.org", "/writer/1", False),
+            ("www.example.org.evil.com", "/reader/1", False),
+            # Other wildcards in the hostname.
+            ("publisher1.example.net", "/x", True),
+            ("publisherA.example.net", "/x", False),
+            ("unknown.example", "/", False),
+        ],
+    )
+    def test_it(self, netloc, path, expected):
+        matcher = URLPatternMatcher(
+            [
+                "example.com/articles/*",
+                "example.com/",
+                "*.example.org/reader/*",
+                "publisher[0-9].example.net/*",
+            ]
+        )
+
+        assert matcher.matches(netloc, path) is expected
+
+    def test_it_with_no_patterns(self):
+        assert URLPatternMatcher([]).matches("example.com", "/") is False
+
+    def test_url_embeds_client_uses_the_given_matcher(self):
+        matcher = URLPatternMatcher(["example.com/*"])
+
+        assert url_embeds_client("https://example.com/foo", matcher) is True
+        assert url_embeds_client("https://web.hypothes.is/blog/", matcher) is False
+
+
+def test_load_patterns(tmp_path):
+    patterns_file = tmp_path / "patterns.txt"
+    patterns_file.write_text(
+        "# A comment\n\nexample.com/*\n  *.example.org/*  # Another comment\n"
+    )
+
+    assert load_patterns(patterns_file) == ["example.com/*", "*.example.org/*"]
+
+
+def test_the_default_patterns_file_loads():
+    assert "www.biorxiv.org/*" in load_patterns(PATTERNS_FILE)
+
+
+class TestContainsMarker:
+    @pytest.mark.parametrize(
+        "chunks,expected",
+        [
+            ([], False),
+            ([b"<html></html>"], False),
+            ([b"<html>", b"", b"<script class='js-hypothesis-config'>"], True),
+            # A marker split across chunks.
+            ([b"<script src='https://hypothes.is/em", b"bed.js'>"], True),
+            ([b"<script src='https://hypothes.is/em", b"b", b"ed.js'>"], True),
+            # Markers are case sensitive.
+            ([b"<script class='JS-HYPOTHESIS-CONFIG'>"], False),
+        ],
+    )
+    def test_it(self, chunks, expected):
+        assert contains_marker(iter(chunks)) is expected
+
+    @pytest.mark.parametrize(
+        "chunks,expected",
+        [
+            ([b"x" * 10, b"js-hypothesis-config"], False),
+            ([b"x" * 9, b"js-hypothesis-config"], False),
+            ([b"x" * 5, b"js-hypothesis-config"], True),
+            ([b"x" * 5 + b"js-hypothesis-config"], True),
+        ],
+    )
+    def test_it_stops_after_max_bytes(self, chunks, expected):
+        assert contains_marker(chunks, max_bytes=25) is expected
+
+    def test_it_stops_reading_chunks_after_max_bytes(self):
+        chunks = iter([b"x" * 10, b"x" * 10, b"js-hypothesis-config"])
+
+        contains_marker(chunks, max_bytes=20)
+
+        assert next(chunks) == b"js-hypothesis-config"
+
+    @pytest.mark.parametrize(
+        "chunks,expected",
+        [
+            ([b"<head>js-hypothesis-config</head>"], True),
+            ([b"<head></head>js-hypothesis-config"], False),
+            ([b"<head></HEAD>", b"js-hypothesis-config"], False),
+            ([b"<head></he", b"ad>", b"js-hypothesis-config"], False),
+        ],
+    )
+    def test_it_can_stop_at_the_end_of_the_head(self, chunks, expected):
+        assert contains_marker(chunks, stop_at_head_end=True) is expected
+
+    def test_it_doesnt_stop_at_the_end_of_the_head_by_default(self):
+        assert contains_marker([b"<head></head>js-hypothesis-config"]) is True
+
+
+class TestPageEmbedsClientWithLimiter:
+    def test_it_acquires_and_releases_the_host(self, limiter):
+        mock_get = response_mock(["<html>", "</html>"])
+        with patch("bouncer.embed_detector.requests.get", return_value=mock_get):
+            page_embeds_client("http://example.com/page", limiter)
+
+        limiter.acquire.assert_called_once_with("example.com")
+        limiter.release.assert_called_once_with("example.com", False)
+
+    def test_it_raises_if_the_host_is_unavailable(self, limiter):
+        limiter.acquire.side_effect = HostUnavailableError
+
+        with patch("bouncer.embed_detector.requests.get") as get:
+            with pytest.raises(HostUnavailableError):
+                page_embeds_client("http://example.com/page", limiter)
+
+        get.assert_not_called()
+        limiter.release.assert_not_called()
+
+    @pytest.mark.parametrize(
+        "side_effect,status_code,failed",
+        [
+            (requests.Timeout, 200, True),
+            (requests.ConnectionError, 200, True),
+            (RuntimeError, 200, False),
+            (None, 404, False),
+            (None, 503, True),
+        ],
+    )
+    def test_it_records_failures(self, limiter, side_effect, status_code, failed):
+        mock_get = response_mock([], status_code=status_code)
+        with patch(
+            "bouncer.embed_detector.requests.get",
+            return_value=mock_get,
+            side_effect=side_effect,
+        ):
+            assert page_embeds_client("http://example.com/page", limiter) is False
+
+        limiter.release.assert_called_once_with("example.com", failed)
+
+    @pytest.fixture
+    def limiter(self):
+        return create_autospec(ProbeLimiter, instance=True, spec_set=True)
+
+
+class TestPageEmbedsClientAsync:
+    @pytest.mark.parametrize(
+        "content,content_type,status_code,expected",
+        [
+            (b"<script class='js-hypothesis-config'>", "text/html", 200, True),
+            (b"<html></html>", "text/html", 200, False),
+            (b"js-hypothesis-config", "application/json", 200, False),
+            (b"js-hypothesis-config", "text/html", 404, False),
+            # A marker in a later chunk.
+            (b" " * 20000 + b"js-hypothesis-config", "text/html", 200, True),
+        ],
+    )
+    def test_it(self, content, content_type, status_code, expected):
+        def handler(request):
+            return httpx.Response(
+                status_code, headers={"Content-Type": content_type}, content=content
+            )
+
+        assert probe(handler) is expected
+
+    def test_it_follows_redirects(self):
+        def handler(request):
+            if request.url.path == "/page":
+                return httpx.Response(302, headers={"Location": "/moved"})
+            return httpx.Response(
+                200,
+                headers={"Content-Type": "text/html"},
+                content=b"js-hypothesis-config",
+            )
+
+        assert probe(handler) is True
+
+    def test_it_can_stop_at_the_end_of_the_head(self):
+        def handler(request):
+            return httpx.Response(
+                200,
+                headers={"Content-Type": "text/html"},
+                content=b"<head></head>js-hypothesis-config",
+            )
+
+        assert probe(handler, stop_at_head_end=True) is False
+
+    def test_it_acquires_and_releases_the_host(self, limiter):
+        def handler(request):
+            return httpx.Response(200, headers={"Content-Type": "text/html"})
+
+        probe(handler, limiter=limiter)
+
+        limiter.acquire.assert_called_once_with("example.com")
+        limiter.release.assert_called_once_with("example.com", False)
+
+    def test_it_raises_if_the_host_is_unavailable(self, limiter):
+        limiter.acquire.side_effect = HostUnavailableError
+        handler = MagicMock()
+
+        with pytest.raises(HostUnavailableError):
+            probe(handler, limiter=limiter)
+
+        handler.assert_not_called()
+        limiter.release.assert_not_called()
+
+    @pytest.mark.parametrize(
+        "exception,status_code,failed",
+        [
+            (httpx.ConnectTimeout, 200, True),
+            (httpx.ConnectError, 200, True),
+            (RuntimeError, 200, False),
+            (None, 404, False),
+            (None, 503, True),
+        ],
+    )
+    def test_it_records_failures(self, limiter, exception, status_code, failed):
+        def handler(request):
+            if exception is not None:
+                raise exception("Failed")
+            return httpx.Response(status_code, headers={"Content-Type": "text/html"})
+
+        assert probe(handler, limiter=limiter) is False
+
+        limiter.release.assert_called_once_with("example.com", failed)
+
+    @pytest.fixture
+    def limiter(self):
+        return create_autospec(ProbeLimiter, instance=True, spec_set=True)
+
+
+class TestAsyncProbeClient:
+    def test_it_doesnt_store_cookies(self):
+        async def get():
+            async with async_probe_client() as client:
+                client._transport = httpx.MockTransport(
+                    lambda request: httpx.Response(
+                        200, headers={"Set-Cookie": "session=secret; Path=/"}
+                    )
+                )
+                await client.get("http://example.com/")
+                return client.cookies
+
+        assert not asyncio.run(get())
+
+
+class TestProbeSession:
+    def test_it_makes_requests_with_a_pooled_session(self, Session, HTTPAdapter):
+        probe_session = ProbeSession(pool_connections=10, pool_maxsize=2)
+
+        response = probe_session.get("http://example.com", timeout=1)
+
+        HTTPAdapter.assert_called_once_with(pool_connections=10, pool_maxsize=2)
+        Session.return_value.mount.assert_any_call("http://", HTTPAdapter.return_value)
+        Session.return_value.mount.assert_any_call("https://", HTTPAdapter.return_value)
+        Session.return_value.get.assert_called_once_with(
+            "http://example.com", timeout=1
+        )
+        assert response == Session.return_value.get.return_value
+
+    def test_it_reuses_the_session(self, Session):
+        probe_session = ProbeSession()
+
+        probe_session.get("http://example.com")
+        probe_session.get("http://example.com")
+
+        Session.assert_called_once_with()
+
+    def test_it_creates_a_new_session_after_a_fork(self, Session, patch):
+        probe_session = ProbeSession()
+        probe_session.get("http://example.com")
+        getpid = patch("bouncer.embed_detector.os.getpid")
+        getpid.return_value = os.getpid() + 1
+
+        probe_session.get("http://example.com")
+
+        assert Session.call_count == 2
+        Session.return_value.close.assert_not_called()
+
+    def test_it_doesnt_keep_cookies(self):
+        session = ProbeSession()._get_session()
+        response = MagicMock()
+        response.info.return_value.get_all.return_value = ["session=secret"]
+        request = requests.Request("GET", "http://example.com").prepare()
+
+        session.cookies.extract_cookies(response, requests.cookies.MockRequest(request))
+
+        assert not session.cookies
+
+    def test_page_embeds_client_uses_the_session(self):
+        session = create_autospec(ProbeSession, instance=True, spec_set=True)
+        session.get.return_value = response_mock(["<html>", "</html>"])
+
+        with patch("bouncer.embed_detector.requests.get") as get:
+            page_embeds_client("http://example.com", session=session)
+
+        session.get.assert_called_once()
+        get.assert_not_called()
+
+    @pytest.fixture
+    def Session(self, patch):
+        Session = patch("bouncer.embed_detector.requests.Session")
+        Session.return_value.cookies = MagicMock()
+        return Session
+
+    @pytest.fixture
+    def HTTPAdapter(self, patch):
+        return patch("bouncer.embed_detector.requests.adapters.HTTPAdapter")
+
+
+class TestProbeLimiter:
+    def test_it_allows_probes(self, limiter):
+        limiter.acquire("example.com")
+        limiter.release("example.com", failed=False)
+
+        assert not limiter.is_open("example.com")
+
+    def test_it_opens_the_circuit_after_too_many_failures(self, limiter):
+        self.fail_probes(limiter, "example.com", 3)
+
+        assert limiter.is_open("example.com")
+        with pytest.raises(HostUnavailableError):
+            limiter.acquire("example.com")
+
+    def test_other_hosts_are_unaffected(self, limiter):
+        self.fail_probes(limiter, "example.com", 3)
+
+        limiter.acquire("example.org")
+
+    def test_failures_outside_the_window_dont_count(self, limiter, clock):
+        self.fail_probes(limiter, "example.com", 2)
+        clock.now += 60
+
+        self.fail_probes(limiter, "example.com", 1)
+
+        assert not limiter.is_open("example.com")
+
+    def test_it_lets_a_single_trial_through_after_the_reset_timeout(
+        self, limiter, clock
+    ):
+        self.fail_probes(limiter, "example.com", 3)
+        clock.now += 30
+
+        limiter.acquire("example.com")
+        with pytest.raises(HostUnavailableError):
+            limiter.acquire("example.com")
+
+    @pytest.mark.parametrize("failed", [True, False])
+    def test_the_trial_closes_or_reopens_the_circuit(self, limiter, clock, failed):
+        self.fail_probes(limiter, "example.com", 3)
+        clock.now += 30
+
+        limiter.acquire("example.com")
+        limiter.release("example.com", failed=failed)
+
+        assert limiter.is_open("example.com") is failed
+
+    def test_it_limits_probes_per_host(self, limiter):
+        limiter.acquire("example.com")
+        limiter.acquire("example.com")
+
+        with pytest.raises(HostUnavailableError):
+            limiter.acquire("example.com")
+
+        limiter.release("example.com", failed=False)
+        limiter.acquire("example.com")
+
+    def test_it_limits_probes_in_total(self, limiter):
+        for host in ["a.example.com", "b.example.com", "c.example.com"]:
+            limiter.acquire(host)
+
+        with pytest.raises(HostUnavailableError):
+            limiter.acquire("d.example.com")
+
+    def test_the_limits_dont_leave_the_trial_in_flight(self, limiter, clock):
+        self.fail_probes(limiter, "example.com", 3)
+        clock.now += 30
+        for host in ["a.example.com", "b.example.com", "c.example.com"]:
+            limiter.acquire(host)
+
+        with pytest.raises(HostUnavailableError):
+            limiter.acquire("example.com")
+        limiter.release("a.example.com", failed=False)
+
+        limiter.acquire("example.com")
+
+    def test_release_tolerates_forgotten_hosts(self, limiter):
+        limiter.acquire("example.com")
+        limiter._hosts.clear()
+
+        limiter.release("example.com", failed=True)
+
+    def test_it_is_thread_safe(self, hammer):
+        limiter = ProbeLimiter(max_per_host=4, max_total=8)
+
+        def probe(thread):
+            for i in range(500):
+                host = f"{i % 3}.example.com"
+                try:
+                    limiter.acquire(host)
+                except HostUnavailableError:
+                    continue
+                limiter.release(host, failed=False)
+
+        hammer(probe)
+
+        # Every slot was released.
+        assert limiter._in_flight == 0
+        assert all(state.in_flight == 0 for state in limiter._hosts.values())
+
+    def fail_probes(self, limiter, host, count):
+        for _ in range(count):
+            limiter.acquire(host)
+            limiter.release(host, failed=True)
+
+    @pytest.fixture
+    def clock(self):
+        class Clock:
+            now = 0.0
+
+            def __call__(self):
+                return self.now
+
+        return Clock()
+
+    @pytest.fixture
+    def limiter(self, clock):
+        return ProbeLimiter(
+            failure_threshold=3,
+            failure_window=60,
+            reset_timeout=30,
+            max_per_host=2,
+            max_total=3,
+            timer=clock,
+        )
+
+
+class TestEmbedDetector:
+    def test_it_checks_the_page(self, page_embeds_client):
+        detector = EmbedDetector()
+
+        assert detector.page_embeds_client("http://example.com") is True
+        page_embeds_client.assert_called_once_with(
+            "http://example.com", **DEFAULT_PROBE_KWARGS
+        )
+
+    def test_it_caches_results(self, page_embeds_client):
+        detector = EmbedDetector()
+
+        detector.page_embeds_client("http://example.com")
+        detector.page_embeds_client("http://example.com")
+
+        page_embeds_client.assert_called_once_with(
+            "http://example.com", **DEFAULT_PROBE_KWARGS
+        )
+
+    def test_it_rechecks_expired_results(self, page_embeds_client, clock):
+        detector = EmbedDetector(cache_ttl=60, timer=clock)
+        detector.page_embeds_client("http://example.com")
+        page_embeds_client.return_value = False
+
+        clock.now += 60
+
+        assert detector.page_embeds_client("http://example.com") is False
+        assert page_embeds_client.call_count == 2
+
+    def test_background_mode_checks_cold_misses_in_the_background(
+        self, page_embeds_client
+    ):
+        detector = EmbedDetector(background=True)
+
+        assert detector.page_embeds_client("http://example.com") is True
+        page_embeds_client.assert_called_once_with(
+            "http://example.com", **DEFAULT_PROBE_KWARGS
+        )
+        assert threading.current_thread() not in page_embeds_client.threads
+
+    def test_background_mode_doesnt_wait_long_for_cold_misses(self, page_embeds_client):
+        detector = EmbedDetector(background=True, cold_miss_timeout=0.01)
+        page_embeds_client.release.clear()
+
+        assert detector.page_embeds_client("http://example.com") is False
+
+        # Once the check finishes its result is cached for the next request.
+        page_embeds_client.release.set()
+        detector._executor.shutdown(wait=True)
+        assert detector.page_embeds_client("http://example.com") is True
+        page_embeds_client.assert_called_once_with(
+            "http://example.com", **DEFAULT_PROBE_KWARGS
+        )
+
+    def test_background_mode_returns_expired_results_while_revalidating(
+        self, page_embeds_client, clock
+    ):
+        detector = EmbedDetector(background=True, cache_ttl=60, timer=clock)
+        detector.page_embeds_client("http://example.com")
+        page_embeds_client.return_value = False
+        page_embeds_client.release.clear()
+        clock.now += 60
+
+        assert detector.page_embeds_client("http://example.com") is True
+
+        page_embeds_client.release.set()
+        detector._executor.shutdown(wait=True)
+        assert detector.page_embeds_client("http://example.com") is False
+
+    def test_background_mode_only_checks_a_page_once_at_a_time(
+        self, page_embeds_client
+    ):
+        detector = EmbedDetector(background=True, cold_miss_timeout=0.01)
+        page_embeds_client.release.clear()
+
+        detector.page_embeds_client("http://example.com")
+        detector.page_embeds_client("http://example.com")
+
+        page_embeds_client.release.set()
+        detector._executor.shutdown(wait=True)
+        page_embeds_client.assert_called_once_with(
+            "http://example.com", **DEFAULT_PROBE_KWARGS
+        )
+
+    def test_background_mode_limits_the_queue(self, page_embeds_client):
+        detector = EmbedDetector(
+            background=True, max_workers=1, max_queued=1, cold_miss_timeout=0.01
+        )
+        page_embeds_client.release.clear()
+
+        detector.page_embeds_client("http://example.com/1")
+        assert detector.page_embeds_client("http://example.com/2") is False
+
+        page_embeds_client.release.set()
+        detector._executor.shutdown(wait=True)
+        page_embeds_client.assert_called_once_with(
+            "http://example.com/1", **DEFAULT_PROBE_KWARGS
+        )
+
+    def test_it_uses_the_shared_cache(self, page_embeds_client, shared_cache):
+        shared_cache.get.return_value = (1, 10)
+        detector = EmbedDetector(shared_cache=shared_cache)
+
+        assert detector.page_embeds_client("http://example.com") is True
+
+        shared_cache.get.assert_called_once_with("http://example.com")
+        page_embeds_client.assert_not_called()
+
+    def test_it_copies_shared_results_into_its_own_cache(
+        self, page_embeds_client, shared_cache
+    ):
+        shared_cache.get.return_value = (0, 10)
+        detector = EmbedDetector(shared_cache=shared_cache)
+
+        detector.page_embeds_client("http://example.com")
+        assert detector.page_embeds_client("http://example.com") is False
+
+        shared_cache.get.assert_called_once_with("http://example.com")
+
+    def test_shared_results_keep_their_age(
+        self, page_embeds_client, shared_cache, clock
+    ):
+        shared_cache.get.return_value = (0, 50)
+        detector = EmbedDetector(cache_ttl=60, shared_cache=shared_cache, timer=clock)
+        detector.page_embeds_client("http://example.com")
+        shared_cache.get.return_value = None
+
+        clock.now += 10
+
+        assert detector.page_embeds_client("http://example.com") is True
+        page_embeds_client.assert_called_once_with(
+            "http://example.com", **DEFAULT_PROBE_KWARGS
+        )
+
+    def test_it_checks_pages_missing_from_the_shared_cache(
+        self, page_embeds_client, shared_cache
+    ):
+        shared_cache.get.return_value = None
+        detector = EmbedDetector(shared_cache=shared_cache)
+
+        assert detector.page_embeds_client("http://example.com") is True
+
+        page_embeds_client.assert_called_once_with(
+            "http://example.com", **DEFAULT_PROBE_KWARGS
+        )
+        shared_cache.set.assert_called_once_with("http://example.com", True)
+
+    def test_url_embeds_client(self):
+        detector = EmbedDetector(url_patterns=URLPatternMatcher(["example.com/*"]))
+
+        assert detector.url_embeds_client("https://example.com/foo") is True
+        assert detector.url_embeds_client("https://web.hypothes.is/blog/") is False
+
+    def test_it_passes_the_page_limits_to_page_embeds_client(self, page_embeds_client):
+        detector = EmbedDetector(max_bytes=1024, stop_at_head_end=True)
+
+        detector.page_embeds_client("http://example.com")
+
+        page_embeds_client.assert_called_once_with(
+            "http://example.com",
+            **dict(DEFAULT_PROBE_KWARGS, max_bytes=1024, stop_at_head_end=True),
+        )
+
+    def test_it_passes_the_limiter_and_session_to_page_embeds_client(
+        self, page_embeds_client
+    ):
+        limiter = ProbeLimiter()
+        session = ProbeSession()
+        detector = EmbedDetector(limiter=limiter, session=session)
+
+        detector.page_embeds_client("http://example.com")
+
+        page_embeds_client.assert_called_once_with(
+            "http://example.com",
+            **dict(DEFAULT_PROBE_KWARGS, limiter=limiter, session=session),
+        )
+
+    def test_it_doesnt_cache_pages_whose_host_is_unavailable(
+        self, page_embeds_client, shared_cache
+    ):
+        page_embeds_client.side_effect = HostUnavailableError
+        detector = EmbedDetector(shared_cache=shared_cache)
+        shared_cache.get.return_value = None
+
+        assert detector.page_embeds_client("http://example.com") is False
+        assert detector.page_embeds_client("http://example.com") is False
+
+        assert page_embeds_client.call_count == 2
+        shared_cache.set.assert_not_called()
+
+    def test_pages_embed_client_checks_pages_concurrently(self, page_embeds_client):
+        detector = EmbedDetector(max_workers=2)
+        pages = ["http://example.com/1", "http://example.com/2"]
+        # Each check waits for the other one to start, so this would raise
+        # BrokenBarrierError if they weren't running at the same time.
+        started = threading.Barrier(2)
+        page_embeds_client.side_effect = lambda page, **kwargs: (
+            started.wait(timeout=1) is not None
+        )
+
+        results = detector.pages_embed_client(pages, timeout=1)
+
+        assert results == {"http://example.com/1": True, "http://example.com/2": True}
+
+    def test_pages_embed_client_uses_cached_results(self, page_embeds_client):
+        detector = EmbedDetector()
+        detector.page_embeds_client("http://example.com")
+        page_embeds_client.reset_mock()
+
+        results = detector.pages_embed_client(["http://example.com"], timeout=1)
+
+        assert results == {"http://example.com": True}
+        page_embeds_client.assert_not_called()
+
+    def test_pages_embed_client_checks_each_page_once(self, page_embeds_client):
+        detector = EmbedDetector()
+
+        results = detector.pages_embed_client(
+            ["http://example.com", "http://example.com"], timeout=1
+        )
+
+        assert results == {"http://example.com": True}
+        page_embeds_client.assert_called_once_with(
+            "http://example.com", **DEFAULT_PROBE_KWARGS
+        )
+
+    def test_pages_embed_client_doesnt_wait_past_the_timeout(
+        self, page_embeds_client, clock
+    ):
+        detector = EmbedDetector(cache_ttl=60, timer=clock)
+        detector.page_embeds_client("http://example.com/expired")
+        clock.now += 60
+        page_embeds_client.release.clear()
+
+        results = detector.pages_embed_client(
+            ["http://example.com/expired", "http://example.com/new"], timeout=0.01
+        )
+
+        # The page with an expired result gets it, the new one is unknown.
+        assert results == {
+            "http://example.com/expired": True,
+            "http://example.com/new": False,
+        }
+        page_embeds_client.release.set()
+        detector._executor.shutdown(wait=True)
+
+    def test_it_only_checks_a_page_once_at_a_time(self, page_embeds_client):
+        detector = EmbedDetector()
+        page_embeds_client.release.clear()
+        results = []
+
+        def check(thread):
+            results.append(detector.page_embeds_client("http://example.com"))
+
+        thread = threading.Thread(target=hammerer, args=(check, 8))
+        thread.start()
+        # Let the first check start and the others wait for it.
+        while not page_embeds_client.threads:
+            pass
+        page_embeds_client.release.set()
+        thread.join()
+
+        assert results == [True] * 8
+        page_embeds_client.assert_called_once()
+
+    def test_threads_waiting_for_a_check_get_its_exception(self, page_embeds_client):
+        detector = EmbedDetector()
+        page_embeds_client.release.clear()
+        page_embeds_client.side_effect = None
+        started = threading.Event()
+
+        def check(page, **kwargs):
+            started.set()
+            page_embeds_client.release.wait()
+            raise KeyboardInterrupt
+
+        page_embeds_client.side_effect = check
+        errors = []
+
+        def waiter():
+            try:
+                detector.page_embeds_client("http://example.com")
+            except KeyboardInterrupt as exc:
+                errors.append(exc)
+
+        checker = threading.Thread(target=waiter)
+        checker.start()
+        started.wait()
+        other = threading.Thread(target=waiter)
+        other.start()
+        while not detector._checking["http://example.com"]._waiters:
+            pass
+        page_embeds_client.release.set()
+        checker.join()
+        other.join()
+
+        assert len(errors) == 2
+        page_embeds_client.assert_called_once()
+        # The failed check doesn't stop the page being checked again.
+        page_embeds_client.side_effect = None
+        page_embeds_client.return_value = True
+        assert detector.page_embeds_client("http://example.com") is True
+
+    def test_it_is_thread_safe(self, page_embeds_client, hammer):
+        detector = EmbedDetector(cache_size=10)
+
+        def check(thread):
+            for i in range(200):
+                assert detector.page_embeds_client(f"http://example.com/{i % 30}")
+
+        hammer(check)
+
+        assert not detector._checking
+
+    def test_pages_embed_client_skips_checks_when_the_queue_is_full(
+        self, page_embeds_client
+    ):
+        detector = EmbedDetector(max_queued=0)
+
+        results = detector.pages_embed_client(["http://example.com"], timeout=1)
+
+        assert results == {"http://example.com": False}
+        page_embeds_client.assert_not_called()
+
+    @pytest.fixture
+    def shared_cache(self):
+        return create_autospec(SharedCache, instance=True, spec_set=True)
+
+    @pytest.fixture
+    def clock(self):
+        class Clock:
+            now = 0.0
+
+            def __call__(self):
+                return self.now
+
+        return Clock()
+
+    @pytest.fixture(autouse=True)
+    def page_embeds_client(self, patch):
+        page_embeds_client = patch("bouncer.embed_detector.page_embeds_client")
+        page_embeds_client.return_value = True
+        # Checks block until `release` is set.
+        page_embeds_client.release = threading.Event()
+        page_embeds_client.release.set()
+        page_embeds_client.threads = []
+
+        def check(page, **kwargs):
+            page_embeds_client.threads.append(threading.current_thread())
+            page_embeds_client.release.wait()
+            return page_embeds_client.return_value
+
+        page_embeds_client.side_effect = check
+        return page_embeds_client
+
+
+class TestEmbedDetectorAsync:
+    def test_it_checks_the_page(self, page_embeds_client_async):
+        detector = EmbedDetector()
+
+        assert asyncio.run(check(detector, "http://example.com")) is True
+        assert page_embeds_client_async.calls == [
+            ("http://example.com", CLIENT, DEFAULT_ASYNC_PROBE_KWARGS)
+        ]
+
+    def test_it_caches_results(self, page_embeds_client_async):
+        detector = EmbedDetector()
+
+        async def check_twice():
+            await check(detector, "http://example.com")
+            return await check(detector, "http://example.com")
+
+        assert asyncio.run(check_twice()) is True
+        assert len(page_embeds_client_async.calls) == 1
+
+    def test_it_rechecks_expired_results(self, page_embeds_client_async, clock):
+        detector = EmbedDetector(cache_ttl=60, timer=clock)
+
+        async def scenario():
+            await check(detector, "http://example.com")
+            page_embeds_client_async.return_value = False
+            clock.now += 60
+            return await check(detector, "http://example.com")
+
+        assert asyncio.run(scenario()) is False
+        assert len(page_embeds_client_async.calls) == 2
+
+    def test_it_shares_its_cache_with_page_embeds_client(
+        self, page_embeds_client_async
+    ):
+        detector = EmbedDetector()
+        asyncio.run(check(detector, "http://example.com"))
+
+        with patch("bouncer.embed_detector.page_embeds_client") as page_embeds_client:
+            assert detector.page_embeds_client("http://example.com") is True
+
+        page_embeds_client.assert_not_called()
+
+    def test_it_returns_False_if_the_host_is_unavailable(
+        self, page_embeds_client_async
+    ):
+        detector = EmbedDetector()
+        page_embeds_client_async.side_effect = HostUnavailableError
+
+        async def check_twice():
+            await check(detector, "http://example.com")
+            return await check(detector, "http://example.com")
+
+        assert asyncio.run(check_twice()) is False
+        # The result isn't cached.
+        assert len(page_embeds_client_async.calls) == 2
+
+    def test_background_mode_doesnt_wait_long_for_cold_misses(
+        self, page_embeds_client_async
+    ):
+        detector = EmbedDetector(background=True, cold_miss_timeout=0.01)
+
+        async def scenario():
+            release = page_embeds_client_async.block()
+            first = await check(detector, "http://example.com")
+
+            # Once the check finishes its result is cached for the next request.
+            release.set()
+            await asyncio.sleep(0)
+            await asyncio.gather(*detector._pending_tasks.values())
+            return first, await check(detector, "http://example.com")
+
+        assert asyncio.run(scenario()) == (False, True)
+        assert len(page_embeds_client_async.calls) == 1
+
+    def test_background_mode_returns_expired_results_while_revalidating(
+        self, page_embeds_client_async, clock
+    ):
+        detector = EmbedDetector(background=True, cache_ttl=60, timer=clock)
+
+        async def scenario():
+            await check(detector, "http://example.com")
+            page_embeds_client_async.return_value = False
+            clock.now += 60
+            stale = await check(detector, "http://example.com")
+
+            await asyncio.gather(*detector._pending_tasks.values())
+            return stale, await check(detector, "http://example.com")
+
+        assert asyncio.run(scenario()) == (True, False)
+        assert len(page_embeds_client_async.calls) == 2
+
+    def test_it_only_checks_a_page_once_at_a_time(self, page_embeds_client_async):
+        detector = EmbedDetector()
+
+        async def scenario():
+            release = page_embeds_client_async.block()
+            checks = asyncio.gather(
+                check(detector, "http://example.com"),
+                check(detector, "http://example.com"),
+            )
+            await asyncio.sleep(0)
+            release.set()
+            return await checks
+
+        assert asyncio.run(scenario()) == [True, True]
+        assert len(page_embeds_client_async.calls) == 1
+
+    def test_it_skips_checks_when_the_queue_is_full(self, page_embeds_client_async):
+        detector = EmbedDetector(max_queued=0)
+
+        assert asyncio.run(check(detector, "http://example.com")) is False
+        assert not page_embeds_client_async.calls
+
+    @pytest.fixture
+    def clock(self):
+        class Clock:
+            now = 0.0
+
+            def __call__(self):
+                return self.now
+
+        return Clock()
+
+    @pytest.fixture(autouse=True)
+    def page_embeds_client_async(self, patch):
+        class FakePageEmbedsClientAsync:
+            """A fake page_embeds_client_async() whose checks can be held up."""
+
+            def __init__(self):
+                self.calls = []
+                self.return_value = True
+                self.side_effect = None
+                self._release = None
+
+            def block(self):
+                """Hold up checks until the returned event is set."""
+                self._release = asyncio.Event()
+                return self._release
+
+            async def __call__(self, page, client, **kwargs):
+                self.calls.append((page, client, kwargs))
+                if self._release is not None:
+                    await self._release.wait()
+                if self.side_effect is not None:
+                    raise self.side_effect
+                return self.return_value
+
+        fake = FakePageEmbedsClientAsync()
+        patch(
+            "bouncer.embed_detector.page_embeds_client_async", new=fake, autospec=None
+        )
+        return fake
+
+
+#: The arguments EmbedDetector passes to page_embeds_client() by default.
+DEFAULT_PROBE_KWARGS = {
+    "limiter": None,
+    "session": None,
+    "max_bytes": MAX_BYTES_TO_CHECK,
+    "stop_at_head_end": False,
+}
+
+
+#: The arguments EmbedDetector passes to page_embeds_client_async() by default.
+DEFAULT_ASYNC_PROBE_KWARGS = {
+    "limiter": None,
+    "max_bytes": MAX_BYTES_TO_CHECK,
+    "stop_at_head_end": False,
+}
+
+#: The httpx client passed to EmbedDetector.page_embeds_client_async().
+CLIENT = object()
+
+
+def probe(handler, **kwargs):
+    """Return the result of page_embeds_client_async() with ``handler`` serving the page."""
+
+    async def probe():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await page_embeds_client_async(
+                "http://example.com/page", client, **kwargs
+            )
+
+    return asyncio.run(probe())
+
+
+async def check(detector, page):
+    return await detector.page_embeds_client_async(page, CLIENT)
+
+
 def random_string_urlsafe(length: int = 16) -> str:
     """Generate a random string to use when calling page_embeds_client, to bypass the LRU cache"""
     return secrets.token_urlsafe(length)[:length]
 
 
 def response_mock(
-    lines: list[str], content_type="text/html", status_code=200
+    chunks: list[str], content_type="text/html", status_code=200
 ) -> MagicMock:
     """
     Mock a response to return from requests.get
@@ -105,9 +1138,7 @@ def response_mock(
     resp = MagicMock()
     resp.status_code = status_code
     resp.headers = {"Content-Type": content_type}
-    resp.iter_lines.return_value = [
-        ln if ln is None else ln.encode("utf-8") for ln in lines
-    ]
+    resp.iter_content.return_value = [chunk.encode("utf-8") for chunk in chunks]
 
     # Make the response usable as a context manager: `with ...:`
     cm = MagicMock()
@@ -0,0 +1,187 @@
+import json
+from unittest import mock
+
+import pytest
+from markupsafe import Markup
+from pyramid import testing
+from pyramid.renderers import render
+
+from bouncer import page_shell
+from bouncer.page_shell import PageShell, PageShellRenderer, minify_css, minify_js
+
+
+class TestMinifyCSS:
+    def test_it_removes_comments_and_whitespace(self):
+        css = """
+        /* A comment. */
+        .center {
+          left: 50%;
+          transform: translate(-50%, -50%);
+        }
+
+        p,
+        div {
+          margin: 0;
+        }
+        """
+
+        assert (
+            minify_css(css)
+            == ".center{left: 50%;transform: translate(-50%,-50%)}p,div{margin: 0}"
+        )
+
+
+class TestMinifyJS:
+    def test_it_removes_comment_lines_and_indentation(self):
+        js = """
+        /**
+         * A doc comment.
+         */
+        function f(a) {
+          // A comment.
+          return a + '// not a comment'; // Kept.
+        }
+        """
+
+        assert minify_js(js) == "\n".join(
+            ["function f(a) {", "return a + '// not a comment'; // Kept.", "}"]
+        )
+
+
+class TestPageShell:
+    def test_it_substitutes_the_fields(self):
+        shell = PageShell(
+            "<title>{title}</title><p>{pretty_url}</p>"
+            "<script>{data}</script><p>{quote}</p>".format(**page_shell._PLACEHOLDERS)
+        )
+
+        html = shell.render(
+            {
+                "title": "<b>Title</b>",
+                "pretty_url": "<i>example.com</i>",
+                "data": "{}",
+            }
+        )
+
+        assert html == (
+            "<title><b>Title</b></title><p>&lt;i&gt;example.com&lt;/i&gt;</p>"
+            "<script>{}</script><p></p>"
+        )
+
+
+class TestPageShellRenderer:
+    @pytest.mark.parametrize(
+        "value",
+        [
+            {
+                "data": json.dumps({"viaUrl": "https://via.example.com/"}),
+                "pretty_url": "example.com",
+            },
+            {
+                "data": json.dumps(
+                    {"viaUrl": None, "extensionUrl": "https://a.b/?x=<y>"}
+                ),
+                "pretty_url": Markup("example.com/&hellip;"),
+                "show_metadata": True,
+                "quote": 'Some "quoted" <text> & more',
+                "text": "It's <b>annotated</b>",
+                "title": Markup("&lsquo;example.com/&hellip;&rsquo;"),
+            },
+            {
+                "data": "{}",
+                "pretty_url": "example.com",
+                "show_metadata": False,
+                "quote": "Quote",
+                "text": "Text",
+                "title": "Title",
+            },
+        ],
+    )
+    def test_it_renders_the_same_page_as_the_template(
+        self, renderer, pyramid_request, value
+    ):
+        expected = render(
+            page_shell.TEMPLATE,
+            {**value, "inline_css": renderer._css, "inline_js": renderer._js},
+            request=pyramid_request,
+        )
+
+        assert renderer(value, {"request": pyramid_request}) == expected
+
+    def test_it_inlines_the_assets(self, renderer, pyramid_request):
+        html = renderer({"data": "{}"}, {"request": pyramid_request})
+
+        assert "<style>body{color: #7a7a7a;" in html
+        assert "export async function redirect(" in html
+        assert "bouncer.css" not in html
+        assert "Return the settings object" not in html
+
+    def test_it_caches_the_shells(self, renderer, pyramid_request, render):
+        renderer({"data": "{}"}, {"request": pyramid_request})
+        renderer({"data": "[]"}, {"request": pyramid_request})
+
+        render.assert_called_once()
+
+    def test_it_renders_a_shell_for_each_application_url(
+        self, renderer, pyramid_request, render
+    ):
+        renderer({"data": "{}"}, {"request": pyramid_request})
+        pyramid_request.application_url = "https://other.example.com"
+        renderer({"data": "{}"}, {"request": pyramid_request})
+
+        assert render.call_count == 2
+
+    def test_it_renders_a_shell_for_each_locale(
+        self, renderer, pyramid_request, render
+    ):
+        renderer({"data": "{}"}, {"request": pyramid_request})
+        pyramid_request.locale_name = "fr"
+        renderer({"data": "{}"}, {"request": pyramid_request})
+
+        assert render.call_count == 2
+
+    def test_it_renders_a_shell_with_and_without_metadata(
+        self, renderer, pyramid_request, render
+    ):
+        renderer({"data": "{}"}, {"request": pyramid_request})
+        renderer({"data": "{}", "show_metadata": True}, {"request": pyramid_request})
+
+        assert render.call_count == 2
+
+    def test_it_doesnt_cache_the_shells_in_debug_mode(
+        self, pyramid_config, pyramid_request, render
+    ):
+        renderer = PageShellRenderer(mock.Mock(settings={"debug": True}))
+
+        renderer({"data": "{}"}, {"request": pyramid_request})
+        renderer({"data": "{}"}, {"request": pyramid_request})
+
+        assert render.call_count == 2
+
+    @pytest.fixture
+    def renderer(self, pyramid_config):
+        return PageShellRenderer(mock.Mock(settings={"debug": False}))
+
+    @pytest.fixture
+    def render(self, patch):
+        return patch("bouncer.page_shell.render", side_effect=render)
+
+    @pytest.fixture
+    def pyramid_request(self):
+        return testing.DummyRequest()
+
+    @pytest.fixture
+    def pyramid_config(self, pyramid_request):
+        settings = {
+            # The templates' paths are relative to the bouncer package.
+            "jinja2.directories": "bouncer:",
+            "jinja2.filters": {
+                "static_path": "pyramid_jinja2.filters:static_path_filter",
+                "static_url": "pyramid_jinja2.filters:static_url_filter",
+            },
+        }
+        with testing.testConfig(request=pyramid_request, settings=settings) as config:
+            config.include("pyramid_jinja2")
+            config.add_static_view(name="static", path="bouncer:static")
+            config.commit()
+            yield config
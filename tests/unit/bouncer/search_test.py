@@ -1,7 +1,11 @@
-from elasticsearch import Elasticsearch
-from mock import ANY, MagicMock, patch
+import asyncio
 
-from bouncer.search import get_client, includeme
+import httpx
+import pytest
+from elasticsearch import Elasticsearch, exceptions
+from mock import ANY, MagicMock, call, create_autospec, patch
+
+from bouncer.search import AsyncClient, ServerVersion, get_client, includeme
 
 
 class TestGetClient(object):
@@ -17,10 +21,214 @@ class TestGetClient(object):
         es_mock.assert_called_once_with(["foo:9200"])
 
 
+class TestAsyncClient:
+    def test_info(self, client, requests):
+        assert asyncio.run(client.info()) == {"version": {"number": "7.10.0"}}
+        assert requests[0].url == "http://es:9200/"
+
+    def test_get(self, client, requests):
+        document = asyncio.run(
+            client.get(
+                index="hypothesis",
+                doc_type="_doc",
+                id="an/id",
+                params={"_source_includes": "uri,target"},
+            )
+        )
+
+        assert document == {"_id": "an/id"}
+        assert requests[0].url.raw_path.startswith(b"/hypothesis/_doc/an%2Fid?")
+        assert requests[0].url.params["_source_includes"] == "uri,target"
+
+    def test_cluster_health(self, client, requests):
+        assert asyncio.run(client.cluster_health("hypothesis")) == {"status": "green"}
+        assert requests[0].url.path == "/_cluster/health/hypothesis"
+
+    @pytest.mark.parametrize(
+        "status,json,text,exception,error",
+        [
+            (404, {"found": False}, None, exceptions.NotFoundError, '{"found":false}'),
+            (
+                400,
+                {"error": {"type": "illegal_argument_exception"}},
+                None,
+                exceptions.RequestError,
+                "illegal_argument_exception",
+            ),
+            (
+                401,
+                {"error": "Unauthorized"},
+                None,
+                exceptions.AuthenticationException,
+                "Unauthorized",
+            ),
+            (503, None, "Unavailable", exceptions.TransportError, "Unavailable"),
+        ],
+    )
+    def test_it_raises_elasticsearch_exceptions_for_error_responses(
+        self, status, json, text, exception, error
+    ):
+        def handler(request):
+            if json is None:
+                return httpx.Response(status, text=text)
+            return httpx.Response(status, json=json)
+
+        client = AsyncClient("http://es:9200", transport=httpx.MockTransport(handler))
+
+        with pytest.raises(exception) as exc_info:
+            asyncio.run(client.info())
+
+        assert exc_info.value.status_code == status
+        assert exc_info.value.error == error
+
+    def test_it_raises_ConnectionError_if_the_request_fails(self):
+        def handler(request):
+            raise httpx.ConnectError("Connection refused", request=request)
+
+        client = AsyncClient("http://es:9200", transport=httpx.MockTransport(handler))
+
+        with pytest.raises(exceptions.ConnectionError):
+            asyncio.run(client.info())
+
+    def test_aclose(self, client):
+        asyncio.run(client.aclose())
+
+        assert client._http.is_closed
+
+    @pytest.fixture
+    def requests(self):
+        return []
+
+    @pytest.fixture
+    def client(self, requests):
+        responses = {
+            "/": {"version": {"number": "7.10.0"}},
+            "/hypothesis/_doc/an%2Fid": {"_id": "an/id"},
+            "/_cluster/health/hypothesis": {"status": "green"},
+        }
+
+        def handler(request):
+            requests.append(request)
+            path = request.url.raw_path.split(b"?")[0].decode()
+            return httpx.Response(200, json=responses[path])
+
+        return AsyncClient("http://es:9200", transport=httpx.MockTransport(handler))
+
+
+class TestServerVersion(object):
+    @pytest.mark.parametrize(
+        "version,major,doc_type,source_includes_param",
+        [
+            ("6.2.0", 6, "annotation", "_source_include"),
+            ("7.10.0", 7, "_doc", "_source_includes"),
+        ],
+    )
+    def test_it_returns_the_server_version(
+        self, client, version, major, doc_type, source_includes_param
+    ):
+        client.info.return_value["version"]["number"] = version
+        server_version = ServerVersion(client, refresh_interval=60)
+
+        assert server_version.major == major
+        assert server_version.doc_type == doc_type
+        assert server_version.source_includes_param == source_includes_param
+
+    def test_it_caches_the_version(self, client, threading):
+        server_version = ServerVersion(client, refresh_interval=60)
+
+        server_version.major
+        server_version.major
+
+        client.info.assert_called_once_with()
+        threading.Thread.assert_not_called()
+
+    def test_it_raises_if_the_first_probe_fails(self, client):
+        client.info.side_effect = RuntimeError("es is down")
+        server_version = ServerVersion(client, refresh_interval=60)
+
+        with pytest.raises(RuntimeError):
+            server_version.major
+
+    def test_it_refreshes_in_the_background_when_stale(self, client, threading, time):
+        server_version = ServerVersion(client, refresh_interval=60)
+        server_version.major
+        time.monotonic.return_value += 60
+        client.info.return_value["version"]["number"] = "7.10.0"
+
+        # The stale version is returned while the refresh is started.
+        assert server_version.major == 6
+        threading.Thread.assert_called_once_with(
+            target=server_version._background_refresh, daemon=True
+        )
+        threading.Thread.return_value.start.assert_called_once_with()
+
+        server_version._background_refresh()
+
+        assert server_version.major == 7
+
+    def test_known(self, client):
+        server_version = ServerVersion(client, refresh_interval=60)
+
+        assert not server_version.known
+        server_version.major  # noqa: B018
+        assert server_version.known
+
+    def test_it_refreshes_after_invalidate(self, client, threading):
+        server_version = ServerVersion(client, refresh_interval=60)
+        server_version.major
+
+        server_version.invalidate()
+        server_version.major
+
+        threading.Thread.assert_called_once_with(target=ANY, daemon=True)
+
+    def test_it_only_starts_one_refresh_at_a_time(self, client, threading):
+        server_version = ServerVersion(client, refresh_interval=60)
+        server_version.major
+        server_version.invalidate()
+
+        server_version.major
+        server_version.major
+
+        threading.Thread.assert_called_once()
+
+    def test_it_keeps_the_stale_version_if_refreshing_fails(self, client, threading):
+        server_version = ServerVersion(client, refresh_interval=60)
+        server_version.major
+        server_version.invalidate()
+        client.info.side_effect = RuntimeError("es is down")
+
+        server_version.major
+        server_version._background_refresh()
+
+        assert server_version.major == 6
+        # The next access after the failed refresh tries again.
+        assert threading.Thread.call_count == 2
+
+    @pytest.fixture
+    def client(self):
+        client = create_autospec(Elasticsearch, instance=True)
+        client.info.return_value = {"version": {"number": "6.2.0"}}
+        return client
+
+    @pytest.fixture(autouse=True)
+    def threading(self, patch):
+        return patch("bouncer.search.threading")
+
+    @pytest.fixture(autouse=True)
+    def time(self, patch):
+        time = patch("bouncer.search.time")
+        time.monotonic.return_value = 1000.0
+        return time
+
+
 def test_includeme():
     configurator = MagicMock()
     configurator.registry.settings = {"elasticsearch_url": "foo:9200"}
 
     includeme(configurator)
 
-    configurator.add_request_method.assert_called_once_with(ANY, name="es", reify=True)
+    assert configurator.add_request_method.call_args_list == [
+        call(ANY, name="es", reify=True),
+        call(ANY, name="es_version", reify=True),
+    ]
@@ -0,0 +1,123 @@
+import os
+import threading
+
+import pytest
+
+from bouncer.shared_cache import SharedCache
+
+
+class TestSharedCache:
+    def test_get_returns_None_on_a_miss(self, cache):
+        assert cache.get("unknown") is None
+
+    def test_get_returns_the_value_and_its_age(self, cache, clock):
+        cache.set("key", True)
+        clock.now += 5
+
+        assert cache.get("key") == (True, 5)
+
+    def test_set_replaces_existing_values(self, cache):
+        cache.set("key", "first")
+        cache.set("key", "second")
+
+        assert cache.get("key") == ("second", 0)
+
+    def test_values_expire_after_ttl(self, cache, clock):
+        cache.set("key", 1)
+        clock.now += 60
+
+        assert cache.get("key") is None
+
+    def test_it_is_shared_between_instances(self, cache, db_path, clock):
+        cache.set("key", 1)
+
+        assert SharedCache(db_path, ttl=60, maxsize=3, timer=clock).get("key") == (
+            1,
+            0,
+        )
+
+    def test_it_is_shared_between_threads(self, cache):
+        thread = threading.Thread(target=cache.set, args=("key", 1))
+        thread.start()
+        thread.join()
+
+        assert cache.get("key") == (1, 0)
+
+    def test_it_reconnects_after_a_fork(self, cache, patch):
+        cache.get("key")
+        connection = cache._local.connection
+        getpid = patch("bouncer.shared_cache.os.getpid")
+        getpid.return_value = os.getpid() + 1
+
+        cache.get("key")
+
+        assert cache._local.connection is not connection
+
+    def test_purge_deletes_expired_entries(self, cache, clock):
+        cache.set("old", 1)
+        clock.now += 30
+        cache.set("new", 2)
+        clock.now += 30
+
+        cache.purge()
+
+        assert self.keys(cache) == ["new"]
+
+    def test_purge_deletes_the_oldest_entries_over_maxsize(self, cache, clock):
+        for key in ["a", "b", "c", "d", "e"]:
+            cache.set(key, 1)
+            clock.now += 1
+
+        cache.purge()
+
+        assert self.keys(cache) == ["c", "d", "e"]
+
+    def test_set_purges_periodically(self, cache, clock):
+        for i in range(SharedCache.PURGE_INTERVAL):
+            cache.set(str(i), i)
+            clock.now += 0.01
+
+        assert len(self.keys(cache)) == 3
+
+    def test_it_is_thread_safe(self, cache, hammer, caplog):
+        def set_values(thread):
+            for i in range(SharedCache.PURGE_INTERVAL):
+                cache.set(f"{thread}_{i}", i)
+
+        hammer(set_values, threads=8)
+
+        # No writes failed and none were lost from the count of writes.
+        assert not caplog.records
+        assert cache._writes == 8 * SharedCache.PURGE_INTERVAL
+
+    def test_errors_are_treated_as_misses(self, tmp_path):
+        # A directory can't be opened as a database.
+        cache = SharedCache(str(tmp_path), ttl=60, maxsize=3)
+
+        cache.set("key", 1)
+
+        assert cache.get("key") is None
+
+    def keys(self, cache):
+        return [
+            row[0]
+            for row in cache._connection().execute("SELECT key FROM cache ORDER BY key")
+        ]
+
+    @pytest.fixture
+    def clock(self):
+        class Clock:
+            now = 1_000_000.0
+
+            def __call__(self):
+                return self.now
+
+        return Clock()
+
+    @pytest.fixture
+    def db_path(self, tmp_path):
+        return str(tmp_path / "cache.sqlite3")
+
+    @pytest.fixture
+    def cache(self, db_path, clock):
+        return SharedCache(db_path, ttl=60, maxsize=3, timer=clock)
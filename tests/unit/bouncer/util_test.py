@@ -131,6 +131,70 @@ def test_parse_document_returns_has_media_time(
     assert parsed["has_media_time"] == has_media_time
 
 
+@pytest.mark.parametrize(
+    "source",
+    [
+        {
+            "authority": "hypothes.is",
+            "group": "__world__",
+            "shared": True,
+            "text": "test_text",
+            "tags": ["not", "needed"],
+            "target": [
+                {
+                    "source": "https://www.youtube.com/watch?v=mBtsNNXjBPw",
+                    "selector": [
+                        {"type": "TextQuoteSelector", "exact": "test_quote"},
+                        {"type": "MediaTimeSelector", "start": 10, "end": 20},
+                    ],
+                }
+            ],
+            "document": {"title": ["Not needed"]},
+        },
+        {
+            "authority": "hypothes.is",
+            "group": "__world__",
+            "shared": True,
+            "target": [{"source": "urn:x-pdf:the-fingerprint"}],
+            "document": {
+                "web_uri": "http://example.com/foo.pdf",
+                "link": [{"href": "http://example.com/not-needed"}],
+            },
+        },
+    ],
+)
+def test_parse_document_only_reads_document_fields(source):
+    document = {"_id": "annotation_id", "_source": source}
+    filtered_document = {
+        "_id": "annotation_id",
+        "_source": filter_source(source, util.DOCUMENT_FIELDS),
+    }
+
+    assert util.parse_document(filtered_document) == util.parse_document(document)
+
+
+def filter_source(source, fields):
+    """Return `source` filtered to `fields` as Elasticsearch's `_source_includes` does."""
+    subfields = {}
+    for field in fields:
+        key, _, subfield = field.partition(".")
+        subfields.setdefault(key, []).append(subfield)
+
+    filtered = {}
+    for key, value in source.items():
+        if key not in subfields:
+            continue
+
+        if not all(subfields[key]):
+            filtered[key] = value
+        elif isinstance(value, list):
+            filtered[key] = [filter_source(item, subfields[key]) for item in value]
+        else:
+            filtered[key] = filter_source(value, subfields[key])
+
+    return filtered
+
+
 @pytest.fixture
 def es_annotation_doc():
     """
@@ -4,28 +4,194 @@ import mock
 import pytest
 from elasticsearch import exceptions as es_exceptions
 from pyramid import httpexceptions, testing
+from webob.etag import ETagMatcher, NoETag
 
-from bouncer import util, views
+from bouncer import annotation_cache, embed_detector, search, util, views
 
 
 @pytest.mark.usefixtures("parse_document")
 class TestAnnotationController(object):
     @pytest.mark.parametrize(
-        "es_version,doc_type",
+        "es_version,doc_type,source_includes_param",
         [
-            ("6.2.0", "annotation"),
-            ("7.10.0", "_doc"),
+            ("6.2.0", "annotation", "_source_include"),
+            ("7.10.0", "_doc", "_source_includes"),
         ],
     )
-    def test_annotation_calls_get(self, es_version, doc_type):
+    def test_annotation_calls_get(self, es_version, doc_type, source_includes_param):
         request = mock_request()
         request.es.info.return_value["version"]["number"] = es_version
         views.AnnotationController(request).annotation()
 
         request.es.get.assert_called_once_with(
-            index="hypothesis", doc_type=doc_type, id="AVLlVTs1f9G3pW-EYc6q"
+            index="hypothesis",
+            doc_type=doc_type,
+            id="AVLlVTs1f9G3pW-EYc6q",
+            params={source_includes_param: ",".join(util.DOCUMENT_FIELDS)},
         )
 
+    def test_annotation_uses_the_cached_server_version(self):
+        request = mock_request()
+
+        views.AnnotationController(request).annotation()
+        views.AnnotationController(request).annotation()
+
+        request.es.info.assert_called_once_with()
+
+    def test_annotation_invalidates_server_version_if_get_fails(self):
+        request = mock_request()
+        request.es.get.side_effect = es_exceptions.ConnectionError
+        request.es_version = mock.create_autospec(
+            search.ServerVersion, instance=True, doc_type="_doc"
+        )
+
+        with pytest.raises(es_exceptions.ConnectionError):
+            views.AnnotationController(request).annotation()
+
+        request.es_version.invalidate.assert_called_once_with()
+
+    def test_annotation_caches_the_parsed_document(self, parse_document):
+        request = mock_request()
+
+        first = views.AnnotationController(request).annotation()
+        second = views.AnnotationController(request).annotation()
+
+        request.es.get.assert_called_once()
+        parse_document.assert_called_once()
+        assert second == first
+
+    @pytest.mark.parametrize(
+        "get_side_effect,parse_side_effect",
+        [
+            (es_exceptions.NotFoundError, None),
+            (None, util.DeletedAnnotationError()),
+        ],
+    )
+    def test_annotation_caches_missing_annotations(
+        self, parse_document, get_side_effect, parse_side_effect
+    ):
+        request = mock_request()
+        request.es.get.side_effect = get_side_effect
+        parse_document.side_effect = parse_side_effect
+
+        for _ in range(2):
+            with pytest.raises(httpexceptions.HTTPNotFound):
+                views.AnnotationController(request).annotation()
+
+        request.es.get.assert_called_once()
+
+    def test_annotation_does_not_cache_invalid_annotations(self, parse_document):
+        request = mock_request()
+        parse_document.side_effect = util.InvalidAnnotationError("message", "reason")
+
+        for _ in range(2):
+            with pytest.raises(httpexceptions.HTTPUnprocessableEntity):
+                views.AnnotationController(request).annotation()
+
+        assert request.es.get.call_count == 2
+
+    def test_annotation_sets_cache_headers(self, parse_document):
+        request = mock_request()
+
+        views.AnnotationController(request).annotation()
+
+        headers = request.response.headers
+        assert headers["Cache-Control"] == "public, max-age=60"
+        assert "Surrogate-Control" not in headers
+        assert headers["Surrogate-Key"] == "annotation-AVLlVTs1f9G3pW-EYc6q"
+        assert request.response.etag == views.annotation_etag(
+            request.registry.settings, parse_document.return_value
+        )
+        assert headers["ETag"].startswith('W/"')
+
+    def test_annotation_sets_configured_cache_headers(self):
+        request = mock_request()
+        request.registry.settings["annotation_page_cache_control"] = None
+        request.registry.settings["annotation_page_surrogate_control"] = "max-age=600"
+        request.matchdict["id"] = "foo bar"
+
+        views.AnnotationController(request).annotation()
+
+        headers = request.response.headers
+        assert "Cache-Control" not in headers
+        assert headers["Surrogate-Control"] == "max-age=600"
+        assert headers["Surrogate-Key"] == "annotation-foo%20bar"
+
+    def test_annotation_returns_not_modified_if_etag_matches(self):
+        request = mock_request()
+        views.AnnotationController(request).annotation()
+        request.if_none_match = ETagMatcher([request.response.etag])
+        request.embed_detector.reset_mock()
+
+        response = views.AnnotationController(request).annotation()
+
+        assert isinstance(response, httpexceptions.HTTPNotModified)
+        assert response.etag == request.response.etag
+        assert response.headers["Cache-Control"] == "public, max-age=60"
+        assert response.headers["Surrogate-Key"] == "annotation-AVLlVTs1f9G3pW-EYc6q"
+        request.embed_detector.page_embeds_client.assert_not_called()
+
+    def test_annotation_renders_the_page_if_etag_doesnt_match(self):
+        request = mock_request()
+        request.if_none_match = ETagMatcher(["something-else"])
+
+        template_data = views.AnnotationController(request).annotation()
+
+        assert template_data["data"]
+
+    @pytest.mark.parametrize(
+        "setting,value",
+        [
+            ("chrome_extension_id", {"default": "other-extension-id"}),
+            ("hypothesis_authority", "other.authority"),
+            ("version", "20240102+gdef5678"),
+            ("via_base_url", "https://via.example.com"),
+        ],
+    )
+    def test_etag_depends_on_settings(self, parse_document, setting, value):
+        settings = mock_request().registry.settings
+        etag = views.annotation_etag(settings, parse_document.return_value)
+
+        settings[setting] = value
+
+        assert views.annotation_etag(settings, parse_document.return_value) != etag
+
+    def test_etag_depends_on_annotation(self, parse_document):
+        settings = mock_request().registry.settings
+        etag = views.annotation_etag(settings, parse_document.return_value)
+
+        parse_document.return_value["text"] = "Edited text"
+
+        assert views.annotation_etag(settings, parse_document.return_value) != etag
+
+    @pytest.mark.parametrize(
+        "get_side_effect,parse_side_effect",
+        [
+            (es_exceptions.NotFoundError, None),
+            (None, util.DeletedAnnotationError()),
+        ],
+    )
+    def test_annotation_sets_not_found_cache_headers(
+        self, parse_document, get_side_effect, parse_side_effect
+    ):
+        request = mock_request()
+        request.registry.settings["annotation_page_not_found_surrogate_control"] = (
+            "max-age=120"
+        )
+        request.es.get.side_effect = get_side_effect
+        parse_document.side_effect = parse_side_effect
+
+        # Once for the Elasticsearch response and once from the cache.
+        for _ in range(2):
+            with pytest.raises(httpexceptions.HTTPNotFound) as exc_info:
+                views.AnnotationController(request).annotation()
+
+            headers = exc_info.value.headers
+            assert headers["Cache-Control"] == "public, max-age=30"
+            assert headers["Surrogate-Control"] == "max-age=120"
+            assert headers["Surrogate-Key"] == "annotation-AVLlVTs1f9G3pW-EYc6q"
+            assert "ETag" not in headers
+
     def test_annotation_raises_http_not_found_if_annotation_deleted(
         self, parse_document
     ):
@@ -131,15 +297,31 @@ class TestAnnotationController(object):
 
         assert data["viaUrl"] is None
 
-    def test_omits_via_url_if_url_embeds_client(self, url_embeds_client):
-        url_embeds_client.return_value = True
+    def test_omits_via_url_if_url_embeds_client(self):
+        request = mock_request()
+        request.embed_detector.url_embeds_client.return_value = True
 
-        template_data = views.AnnotationController(mock_request()).annotation()
+        template_data = views.AnnotationController(request).annotation()
         data = json.loads(template_data["data"])
 
-        url_embeds_client.assert_called_with("http://www.example.com/example.html")
+        request.embed_detector.url_embeds_client.assert_called_with(
+            "http://www.example.com/example.html"
+        )
         assert data["viaUrl"] is None
 
+    @pytest.mark.parametrize("embeds", [True, False])
+    def test_annotation_returns_whether_page_embeds_client(self, embeds):
+        request = mock_request()
+        request.embed_detector.page_embeds_client.return_value = embeds
+
+        template_data = views.AnnotationController(request).annotation()
+
+        data = json.loads(template_data["data"])
+        request.embed_detector.page_embeds_client.assert_called_once_with(
+            "http://www.example.com/example.html"
+        )
+        assert data["isClientEmbedded"] is embeds
+
     @pytest.mark.parametrize(
         "document_uri,has_media_time,use_via",
         [
@@ -264,18 +446,232 @@ class TestGotoUrlController(object):
         )
         assert data["extensionUrl"] == "https://example.com/#annotations:query:"
 
-    def test_it_does_not_use_via_if_url_embeds_client(self, url_embeds_client):
+    def test_it_does_not_use_via_if_url_embeds_client(self):
         request = mock_request()
         request.GET["url"] = "https://example.com/#foobar"
-        url_embeds_client.return_value = True
+        request.embed_detector.url_embeds_client.return_value = True
 
         ctx = views.goto_url(request)
 
         data = json.loads(ctx["data"])
-        url_embeds_client.assert_called_with("https://example.com/")
+        request.embed_detector.url_embeds_client.assert_called_with(
+            "https://example.com/"
+        )
         assert data["viaUrl"] is None
 
 
+class TestResolve:
+    def test_it_returns_the_redirect_data(self):
+        request = resolve_request(["id_1"])
+        request.es.mget.return_value = {
+            "docs": [es_document("id_1", "https://example.com/page#frag")]
+        }
+
+        result = views.resolve(request)
+
+        assert result == {
+            "annotations": {
+                "id_1": {
+                    "alwaysUseVia": False,
+                    "chromeExtensionId": "test-extension-id",
+                    "extensionUrl": "https://example.com/page#annotations:id_1",
+                    "isClientEmbedded": False,
+                    "viaUrl": "https://via.hypothes.is/https://example.com/page#annotations:id_1",
+                    "showMetadata": True,
+                    "quote": "the quote",
+                    "text": "the text",
+                    "title": "Hypothesis annotation for example.com",
+                }
+            }
+        }
+
+    def test_it_returns_the_same_data_as_the_annotation_page(self):
+        request = resolve_request(["id_1"])
+        request.es.mget.return_value = {
+            "docs": [es_document("id_1", "https://example.com/")]
+        }
+        request.es.get.return_value = es_document("id_1", "https://example.com/")
+        request.matchdict = {"id": "id_1"}
+
+        result = views.resolve(request)["annotations"]["id_1"]
+        page = views.AnnotationController(request).annotation()
+
+        assert json.loads(page["data"]).items() <= result.items()
+
+    def test_it_fetches_the_annotations_with_one_mget(self):
+        request = resolve_request(["id_1", "id_2", "id_1"])
+        request.es.mget.return_value = {
+            "docs": [es_document("id_1"), es_document("id_2")]
+        }
+
+        result = views.resolve(request)
+
+        request.es.mget.assert_called_once_with(
+            body={"ids": ["id_1", "id_2"]},
+            index="hypothesis",
+            doc_type="annotation",
+            params={"_source_include": ",".join(util.DOCUMENT_FIELDS)},
+        )
+        assert list(result["annotations"]) == ["id_1", "id_2"]
+
+    def test_it_uses_and_fills_the_annotation_cache(self):
+        request = resolve_request(["id_1", "id_2"])
+        request.annotation_cache.set("id_1", util.parse_document(es_document("id_1")))
+        request.es.mget.return_value = {"docs": [es_document("id_2")]}
+
+        views.resolve(request)
+
+        request.es.mget.assert_called_once()
+        assert request.es.mget.call_args[1]["body"] == {"ids": ["id_2"]}
+        assert request.annotation_cache.get("id_2")["annotation_id"] == "id_2"
+
+    def test_it_doesnt_call_elasticsearch_if_everything_is_cached(self):
+        request = resolve_request(["id_1"])
+        request.annotation_cache.set_missing("id_1", annotation_cache.NOT_FOUND)
+
+        views.resolve(request)
+
+        request.es.mget.assert_not_called()
+
+    def test_it_returns_per_annotation_errors(self):
+        request = resolve_request(
+            ["found", "missing", "deleted", "no_uri", "file_uri", "failed"]
+        )
+        request.es.mget.return_value = {
+            "docs": [
+                es_document("found"),
+                {"_id": "missing", "found": False},
+                es_document("deleted", deleted=True),
+                {"_id": "no_uri", "found": True, "_source": {**SOURCE, "target": []}},
+                es_document("file_uri", "file:///home/user/file.pdf"),
+                {"_id": "failed", "error": {"type": "some_error"}},
+            ]
+        }
+
+        results = views.resolve(request)["annotations"]
+
+        assert "error" not in results["found"]
+        assert {
+            id_: result.get("error", {}).get("status")
+            for id_, result in results.items()
+        } == {
+            "found": None,
+            "missing": 404,
+            "deleted": 404,
+            "no_uri": 422,
+            "file_uri": 422,
+            "failed": 502,
+        }
+        assert results["missing"]["error"]["message"] == "Annotation not found"
+        assert results["no_uri"]["error"]["message"] == "The annotation has no URI"
+
+    def test_it_caches_missing_and_deleted_annotations(self):
+        request = resolve_request(["missing", "deleted"])
+        request.es.mget.return_value = {
+            "docs": [
+                {"_id": "missing", "found": False},
+                es_document("deleted", deleted=True),
+            ]
+        }
+
+        views.resolve(request)
+
+        assert request.annotation_cache.get("missing") == annotation_cache.NOT_FOUND
+        assert request.annotation_cache.get("deleted") == annotation_cache.DELETED
+
+    def test_it_invalidates_server_version_if_mget_fails(self):
+        request = resolve_request(["id_1"])
+        request.es.mget.side_effect = es_exceptions.ConnectionError
+        request.es_version = mock.create_autospec(
+            search.ServerVersion, instance=True, doc_type="_doc"
+        )
+
+        with pytest.raises(es_exceptions.ConnectionError):
+            views.resolve(request)
+
+        request.es_version.invalidate.assert_called_once_with()
+
+    def test_it_probes_the_pages_together(self):
+        request = resolve_request(["id_1", "id_2", "id_3"])
+        request.es.mget.return_value = {
+            "docs": [
+                es_document("id_1", "https://example.com/1"),
+                es_document("id_2", "https://example.com/2"),
+                es_document(
+                    "id_3",
+                    "https://www.youtube.com/watch?v=1",
+                    selector=[{"type": "MediaTimeSelector"}],
+                ),
+            ]
+        }
+        request.embed_detector.pages_embed_client.side_effect = None
+        request.embed_detector.pages_embed_client.return_value = {
+            "https://example.com/1": True,
+            "https://example.com/2": False,
+        }
+
+        results = views.resolve(request)["annotations"]
+
+        # Pages that are always shown with Via don't need probing.
+        request.embed_detector.pages_embed_client.assert_called_once_with(
+            ["https://example.com/1", "https://example.com/2"], timeout=2.0
+        )
+        assert results["id_1"]["isClientEmbedded"] is True
+        assert results["id_2"]["isClientEmbedded"] is False
+        assert results["id_3"]["isClientEmbedded"] is False
+        assert results["id_3"]["alwaysUseVia"] is True
+
+    def test_it_unescapes_the_title(self):
+        long_host = "a" * 100 + ".com"
+        request = resolve_request(["id_1"])
+        request.es.mget.return_value = {
+            "docs": [es_document("id_1", f"https://{long_host}/")]
+        }
+
+        result = views.resolve(request)["annotations"]["id_1"]
+
+        assert result["title"].endswith("\u2026")
+
+    @pytest.mark.parametrize(
+        "json_body", [[], {}, {"ids": "id_1"}, {"ids": [1]}, {"ids": [""]}]
+    )
+    def test_it_rejects_invalid_requests(self, json_body):
+        request = resolve_request([])
+        request.json_body = json_body
+
+        result = views.resolve(request)
+
+        assert request.response.status_int == 400
+        assert "error" in result
+
+    def test_it_rejects_invalid_json(self):
+        request = resolve_request([])
+        del request.json_body
+
+        # DummyRequest doesn't have a json_body property so give it one.
+        with mock.patch.object(
+            type(request),
+            "json_body",
+            new_callable=mock.PropertyMock,
+            side_effect=ValueError("Invalid JSON"),
+            create=True,
+        ):
+            result = views.resolve(request)
+
+        assert request.response.status_int == 400
+        assert "error" in result
+
+    def test_it_limits_the_batch_size(self):
+        request = resolve_request(["id_1", "id_2", "id_3"])
+        request.registry.settings["resolve_max_ids"] = 2
+
+        result = views.resolve(request)
+
+        assert request.response.status_int == 400
+        assert result == {"error": "At most 2 annotation IDs can be resolved at once"}
+        request.es.mget.assert_not_called()
+
+
 class TestErrorController(object):
     def test_httperror_sets_status_code(self):
         request = mock_request()
@@ -284,6 +680,23 @@ class TestErrorController(object):
 
         assert request.response.status_int == 404
 
+    def test_httperror_copies_cache_headers(self):
+        request = mock_request()
+        exc = httpexceptions.HTTPNotFound(
+            headers={
+                "Cache-Control": "public, max-age=30",
+                "Surrogate-Key": "annotation-foo",
+                "X-Other": "other",
+            }
+        )
+
+        views.ErrorController(exc, request).httperror()
+
+        assert request.response.headers["Cache-Control"] == "public, max-age=30"
+        assert request.response.headers["Surrogate-Key"] == "annotation-foo"
+        assert "Surrogate-Control" not in request.response.headers
+        assert "X-Other" not in request.response.headers
+
     def test_httperror_returns_error_message(self):
         exc = httpexceptions.HTTPNotFound("Annotation not found")
         controller = views.ErrorController(exc, mock_request())
@@ -383,9 +796,41 @@ def parse_document(request):
     return parse_document
 
 
+#: The _source of a valid annotation.
+SOURCE = {
+    "authority": "localhost",
+    "group": "__world__",
+    "shared": True,
+    "text": "the text",
+}
+
+
+def es_document(
+    annotation_id, uri="https://example.com/", deleted=False, selector=None
+):
+    """Return an Elasticsearch get or mget document for an annotation."""
+    if selector is None:
+        selector = [{"type": "TextQuoteSelector", "exact": "the quote"}]
+    source = dict(SOURCE, target=[{"source": uri, "selector": selector}])
+    if deleted:
+        source["deleted"] = True
+    return {"_id": annotation_id, "found": True, "_source": source}
+
+
+def resolve_request(annotation_ids):
+    request = mock_request()
+    request.method = "POST"
+    request.json_body = {"ids": annotation_ids}
+    return request
+
+
 def mock_request():
     request = testing.DummyRequest()
     request.registry.settings = {
+        "annotation_page_cache_control": "public, max-age=60",
+        "annotation_page_not_found_cache_control": "public, max-age=30",
+        "annotation_page_not_found_surrogate_control": None,
+        "annotation_page_surrogate_control": None,
         "chrome_extension_id": {
             "default": "test-extension-id",
             "alt.authority": "alt-extension-id",
@@ -395,8 +840,12 @@ def mock_request():
         "elasticsearch_index": "hypothesis",
         "hypothesis_authority": "localhost",
         "hypothesis_url": "https://hypothes.is",
+        "resolve_max_ids": 500,
+        "resolve_probe_timeout": 2,
+        "version": "20240101+gabc1234",
         "via_base_url": "https://via.hypothes.is",
     }
+    request.if_none_match = NoETag
     request.matchdict = {"id": "AVLlVTs1f9G3pW-EYc6q"}
     request.es = mock.Mock()
 
@@ -413,21 +862,22 @@ def mock_request():
             "number": "6.2.0",
         }
     }
+    request.es_version = search.ServerVersion(request.es, refresh_interval=3600)
+    request.annotation_cache = annotation_cache.AnnotationCache(
+        maxsize=100, ttl=60, negative_ttl=30
+    )
+    request.embed_detector = mock.create_autospec(
+        embed_detector.EmbedDetector, instance=True
+    )
+    request.embed_detector.url_embeds_client.return_value = False
+    request.embed_detector.page_embeds_client.return_value = False
+    request.embed_detector.pages_embed_client.side_effect = lambda pages, timeout: {
+        page: False for page in pages
+    }
     request.raven = mock.Mock()
     return request
 
 
-@pytest.fixture(autouse=True)
-def url_embeds_client():
-    patcher = mock.patch("bouncer.views.url_embeds_client")
-    url_embeds_client = patcher.start()
-    url_embeds_client.return_value = False
-
-    yield url_embeds_client
-
-    patcher.stop()
-
-
 @pytest.fixture(autouse=True)
 def capture_message(patch):
     return patch("bouncer.views.capture_message")